@@ -11,10 +11,30 @@
 #
 
 
+def _sorted_frame_times(frame_times):
+    from numpy import asarray, sort, all, diff
+
+    frame_times = asarray(frame_times)
+    # counting frames before an event does not depend on their order, so sorting keeps the result unchanged
+    if not all(diff(frame_times) >= 0):
+        frame_times = sort(frame_times)
+    return frame_times
+
+
+def _frames_before(events, frame_times):
+    """
+    For each event, return the number of frames in sorted frame_times that occur strictly before it, minus one: the
+    index of the nearest frame before the event, or -1 if there is none.
+    """
+    from numpy import asarray, searchsorted
+
+    return searchsorted(frame_times, asarray(events), side="left") - 1
+
+
 def match_cam_time(events, frame_times):
     """
     Helper function for mapping ephys events to camera times. For each event in events, we return the nearest
-    camera frame before the event.
+    camera frame before the event. Events that occur before the first frame are dropped.
 
 
     Parameters
@@ -27,17 +47,39 @@ def match_cam_time(events, frame_times):
         Timepoints of camera frames to be assigned to events. Sampled at a lower rate than events.
 
     """
-    from numpy import array
+    before = _frames_before(events, _sorted_frame_times(frame_times))
+    return before[before >= 0]
+
+
+def match_cam_times(events, frame_times, drop=False):
+    """
+    Map several arrays of events (e.g. swim starts, swim stops and stimulus onsets) to the nearest camera frame (or
+    volume) before each event in one call. Frame times are prepared once and shared by all event arrays.
+
+
+    Parameters
+    ----------
+
+     events : dict of 1D numpy arrays
+        Events of interest, keyed by name.
+
+     frame_times : 1D numpy array
+        Timepoints of camera frames or volumes to be assigned to events.
 
-    output = []
-    for a in events:
-        lags = array(a - frame_times)
-        before = len(lags[lags > 0]) - 1
+     drop : bool
+        If True, drop events before the first frame, as match_cam_time does. If False, they are assigned -1 so that
+        every output has the length of its input, which keeps e.g. swim starts and stops paired.
 
-        if before >= 0:
-            output.append(before)
+    Returns a dict of index arrays with the keys of events.
+    """
+    frame_times = _sorted_frame_times(frame_times)
+
+    result = {}
+    for name, ev in events.items():
+        before = _frames_before(ev, frame_times)
+        result[name] = before[before >= 0] if drop else before
 
-    return array(output)
+    return result
 
 
 def chop_trials(signal, thr=2000):
@@ -99,7 +141,30 @@ def estimate_onset(signal, threshold, duration):
     return inits[valid]
 
 
-def estimate_swims(signal, fs=6000, scaling=1.6):
+def _group_swims(burst_inds, inter_swim_min):
+    """
+    Group burst indices into swims: consecutive bursts closer than inter_swim_min belong to the same swim, and swims
+    with a single burst are discarded. Returns the indices of the first and last burst of each swim.
+    """
+    from numpy import where, diff, concatenate
+
+    if burst_inds.size == 0:
+        return burst_inds, burst_inds
+
+    interSwims = diff(burst_inds)
+    swimEndIndB = where(interSwims > inter_swim_min)[0]
+    swimEndIndB = concatenate((swimEndIndB, [burst_inds.size - 1]))
+
+    swimStartIndB = swimEndIndB[:-1] + 1
+    swimStartIndB = concatenate(([0], swimStartIndB))
+    nonShort = where(swimEndIndB != swimStartIndB)[0]
+    swimStartIndB = swimStartIndB[nonShort]
+    swimEndIndB = swimEndIndB[nonShort]
+
+    return burst_inds[swimStartIndB], burst_inds[swimEndIndB]
+
+
+def estimate_swims(signal, fs=6000, scaling=1.6, peak_order="height"):
     """ Estimate swim timing from ephys recording of motor neurons
 
     Parameters
@@ -110,9 +175,12 @@ def estimate_swims(signal, fs=6000, scaling=1.6):
     fs : int
         sampling rate of the data, in Hz
 
+    peak_order : string
+        How bursts closer than the dead time are resolved, see estimate_peaks.
+
     """
 
-    from numpy import zeros, where, diff, concatenate
+    from numpy import zeros, where
 
     # set dead time between peaks, in seconds. This prevents duplicate swims.
     dead_time = 0.010 * fs
@@ -123,32 +191,36 @@ def estimate_swims(signal, fs=6000, scaling=1.6):
     # estimate swim threshold
     thr = estimate_threshold(signal, fs * 60, scaling=scaling)
 
-    peaksT, peaksIndT = estimate_peaks(signal, dead_time)
+    peaksIndT = estimate_peaks(signal, dead_time, order=peak_order)
 
     burstIndT = peaksIndT[where(signal[peaksIndT] > thr[peaksIndT])]
-    burstT = zeros(signal.shape)
-    burstT[burstIndT] = 1
+    swimStartIndT, swimEndIndT = _group_swims(burstIndT, inter_swim_min)
 
-    interSwims = diff(burstIndT)
-    swimEndIndB = where(interSwims > inter_swim_min)[0]
-    swimEndIndB = concatenate((swimEndIndB, [burstIndT.size - 1]))
-
-    swimStartIndB = swimEndIndB[:-1] + 1
-    swimStartIndB = concatenate(([0], swimStartIndB))
-    nonShort = where(swimEndIndB != swimStartIndB)[0]
-    swimStartIndB = swimStartIndB[nonShort]
-    swimEndIndB = swimEndIndB[nonShort]
-
-    bursts = zeros(signal.size)
     starts = zeros(signal.size)
     stops = zeros(signal.size)
-    bursts[burstIndT] = 1
-    starts[burstIndT[swimStartIndB]] = 1
-    stops[burstIndT[swimEndIndB]] = 1
+    starts[swimStartIndT] = 1
+    stops[swimEndIndT] = 1
 
     return starts, stops, thr
 
 
+def _variance_kernels(kern_mean=None, kern_var=None, fs=6000):
+    from scipy.signal.windows import gaussian
+
+    # set the width of the kernels to use for smoothing
+    kw = int(0.04 * fs)
+
+    if kern_mean is None:
+        kern_mean = gaussian(kw, kw // 10)
+        kern_mean /= kern_mean.sum()
+
+    if kern_var is None:
+        kern_var = gaussian(kw, kw // 10)
+        kern_var /= kern_var.sum()
+
+    return kern_mean, kern_var
+
+
 def windowed_variance(signal, kern_mean=None, kern_var=None, fs=6000):
     """
     Estimate smoothed sliding variance of the input signal
@@ -164,22 +236,13 @@ def windowed_variance(signal, kern_mean=None, kern_var=None, fs=6000):
     fs : int
         sampling rate of the data
     """
-    from scipy.signal import gaussian, fftconvolve
+    from scipy.signal import fftconvolve
 
     # # workaround for Intel MKL DFTI ERROR
     # import numpy as np
     # np.fft.restore_all()
 
-    # set the width of the kernels to use for smoothing
-    kw = int(0.04 * fs)
-
-    if kern_mean is None:
-        kern_mean = gaussian(kw, kw // 10)
-        kern_mean /= kern_mean.sum()
-
-    if kern_var is None:
-        kern_var = gaussian(kw, kw // 10)
-        kern_var /= kern_var.sum()
+    kern_mean, kern_var = _variance_kernels(kern_mean, kern_var, fs)
 
     mean_estimate = fftconvolve(signal, kern_mean, "same")
     var_estimate = (signal - mean_estimate) ** 2
@@ -188,10 +251,67 @@ def windowed_variance(signal, kern_mean=None, kern_var=None, fs=6000):
     return fltch, var_estimate, mean_estimate
 
 
-def estimate_peaks(signal, dead_time):
+def chunk_bounds(n_samples, chunk_size, overlap):
+    """
+    Split the range [0, n_samples) into consecutive chunks, each extended by overlap samples on both sides.
+    Yields (start, stop, padded_start, padded_stop) for each chunk.
+    """
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        yield start, stop, max(start - overlap, 0), min(stop + overlap, n_samples)
+
+
+def windowed_variance_chunked(signal, chunk_size=3600000, kern_mean=None, kern_var=None, fs=6000, extra=0):
+    """
+    Estimate the smoothed sliding variance of a long signal chunk by chunk, e.g. of one channel of a memory-mapped
+    recording. Each chunk is read with an overlap of the combined width of both kernels, so the stitched results equal
+    those of windowed_variance on the whole signal, up to the rounding of the FFT. Memory use depends on chunk_size,
+    not on the length of the signal.
+
+    Yields (start, stop, fltch, var_estimate, mean_estimate) for consecutive chunks, where the arrays cover samples
+    [start, stop + extra) of the signal.
+
+    signal : numpy array or memmap, 1-dimensional
+
+    chunk_size : int
+        Number of samples per chunk. Defaults to 10 minutes at 6 kHz.
+
+    kern_mean, kern_var, fs : see windowed_variance
+
+    extra : int
+        Number of samples past the end of each chunk to include in the output, for operations that need to look
+        ahead across the chunk boundary.
+    """
+    from numpy import asarray
+    from scipy.signal import fftconvolve
+
+    kern_mean, kern_var = _variance_kernels(kern_mean, kern_var, fs)
+    overlap = kern_mean.size + kern_var.size + extra
+
+    for start, stop, pstart, pstop in chunk_bounds(signal.shape[0], chunk_size, overlap):
+        chunk = asarray(signal[pstart:pstop])
+        mean_estimate = fftconvolve(chunk, kern_mean, "same")
+        var_estimate = (chunk - mean_estimate) ** 2
+        fltch = fftconvolve(var_estimate, kern_var, "same")
+
+        valid = slice(start - pstart, min(stop + extra, signal.shape[0]) - pstart)
+        yield start, stop, fltch[valid], var_estimate[valid], mean_estimate[valid]
+
+
+def _peak_distance(dead_time):
+    # peaks must be more than dead_time samples apart
+    from numpy import floor
+
+    return int(floor(dead_time)) + 1
+
+
+def estimate_peaks(signal, dead_time, order="height", dense=False):
     """
     Estimate peak times in a signal, with a minimum distance between estimated peaks.
 
+    Peaks are the local maxima of the signal (the middle sample of flat maxima); the first and last samples are
+    never peaks. Every pair of returned peaks is more than dead_time samples apart.
+
     Parameters
     __________
 
@@ -200,35 +320,59 @@ def estimate_peaks(signal, dead_time):
     dead_time : int
         minimum number of sample between estimated peaks
 
-    """
+    order : string
+        How peaks closer than dead_time are resolved.
+        'height' : keep the highest peak, then the highest of the remaining peaks that are far enough from it, and
+                   so on (scipy.signal.find_peaks with a distance).
+        'time' : keep the earliest peak, then the next peak that is far enough from the last kept one, and so on.
 
-    from numpy import diff, where, zeros
+    dense : bool
+        If True, also return a boolean mask with the shape of signal that is True at the peaks.
 
-    aa = diff(signal)
-    peaks = (aa[:-1] > 0) * (aa[1:] < 0)
-    inds = where(peaks)[0]
+    Returns the indices of the peaks, or (mask, indices) if dense is True.
+    """
+    from numpy import zeros, searchsorted
+    from scipy.signal import find_peaks
 
-    # take the difference between consecutive indices
-    d_inds = diff(inds)
+    if order not in ("height", "time"):
+        raise ValueError("order must be 'height' or 'time'")
 
-    # find differences greater than deadtime
-    to_keep = d_inds > dead_time
+    distance = _peak_distance(dead_time)
 
-    # only keep the indices corresponding to differences greater than deadT
-    inds[1:] = inds[1:] * to_keep
-    inds = inds[inds.nonzero()]
+    if order == "height":
+        inds = find_peaks(signal, distance=distance)[0]
+    else:
+        candidates = find_peaks(signal)[0]
+        keep = []
+        ind = 0
+        # jump from each kept peak to the first candidate far enough from it
+        while ind < candidates.size:
+            keep.append(ind)
+            ind = searchsorted(candidates, candidates[ind] + distance, side="left")
+        inds = candidates[keep]
 
-    peaks = zeros(signal.shape[0])
-    peaks[inds] = 1
+    if dense:
+        peaks = zeros(signal.shape[0], dtype="bool")
+        peaks[inds] = True
+        return peaks, inds
 
-    return peaks, inds
+    return inds
 
 
-def load(in_file, num_channels=10, memmap=False):
+def load(in_file, num_channels=10, memmap=False, channel_major=False):
     """Load multichannel binary data from disk, return as a [channels,samples] sized numpy array
+
+    If memmap is True the result is a view of a memory-mapped file and nothing is read until it is accessed, e.g.
+    by estimate_swims_chunked for recordings that do not fit in memory.
+
+    If channel_major is True as well, the view is of a channel-contiguous cache of the file (see EphysFile.cache),
+    which is created on first use. Reading one channel of it then only reads the bytes of that channel.
     """
     from numpy import fromfile, float32
 
+    if memmap and channel_major:
+        return EphysFile(in_file, num_channels=num_channels).cache()
+
     if memmap:
         from numpy import memmap
 
@@ -245,10 +389,162 @@ def load(in_file, num_channels=10, memmap=False):
     return data
 
 
-def estimate_threshold(signal, window=180000, scaling=1.6, lower_percentile=0.01):
+class EphysFile(object):
+
+    """
+    Lazy access to a multichannel float32 recording (e.g. a .10chFlt file), which is stored sample-major: the values
+    of all channels at one timepoint are adjacent. Reading one channel of such a file reads the whole file, so the
+    file can be converted once into a channel-contiguous cache (a .npy file next to it), after which channels and
+    time ranges are read directly from the cache.
+
+    ep = EphysFile('/path/to/recording.10chFlt')
+    ep.cache()
+    motor = ep[[0, 1], :6000 * 60]
+    """
+
+    def __init__(self, path, num_channels=10, cache_path=None):
+        """
+        path : string, path to the recording.
+
+        num_channels : int, number of interleaved channels.
+
+        cache_path : string or None, location of the channel-contiguous cache. Defaults to path + '.channels.npy'.
+        An existing cache is used if it matches the recording and is newer than it.
+        """
+        from numpy import memmap
+        from os.path import exists, getmtime
+
+        self.path = path
+        self.num_channels = num_channels
+        self.cache_path = path + ".channels.npy" if cache_path is None else cache_path
+
+        raw = memmap(path, dtype="float32", mode="r")
+        self.n_samples = raw.size // num_channels
+        if raw.size % num_channels > 0:
+            print("Data needed to be truncated!")
+        self._raw = raw[: self.n_samples * num_channels].reshape(self.n_samples, num_channels)
+
+        self._channels = None
+        if exists(self.cache_path) and getmtime(self.cache_path) >= getmtime(path):
+            self._open_cache()
+
+    def _open_cache(self):
+        from numpy import load
+
+        channels = load(self.cache_path, mmap_mode="r")
+        if channels.shape == self.shape and channels.dtype == self.dtype:
+            self._channels = channels
+
+    @property
+    def shape(self):
+        return (self.num_channels, self.n_samples)
+
+    @property
+    def dtype(self):
+        return self._raw.dtype
+
+    @property
+    def is_cached(self):
+        return self._channels is not None
+
+    def __repr__(self):
+        return "Recording at {0} with shape {1}, {2}".format(
+            self.path, self.shape, "cached" if self.is_cached else "not cached"
+        )
+
+    def cache(self, chunk_samples=2 ** 20):
+        """
+        Write the channel-contiguous cache, unless a valid one exists, reading the recording once in chunks of
+        chunk_samples timepoints. Returns the cache as a read-only memmap with shape (channels, samples).
+        """
+        from numpy.lib.format import open_memmap
+        import os
+
+        if self._channels is None:
+            tmp = "{0}.{1}.tmp.npy".format(self.cache_path[: -len(".npy")], os.getpid())
+            out = open_memmap(tmp, mode="w+", dtype=self.dtype, shape=self.shape)
+            for start in range(0, self.n_samples, chunk_samples):
+                stop = min(start + chunk_samples, self.n_samples)
+                out[:, start:stop] = self._raw[start:stop].T
+            out.flush()
+            del out
+            # rename when complete, so an interrupted conversion never leaves a partial cache
+            os.replace(tmp, self.cache_path)
+            self._open_cache()
+
+        return self._channels
+
+    def channel(self, ch, start=0, stop=None):
+        """
+        Return samples [start, stop) of one channel as a contiguous numpy array.
+        """
+        return self[ch, start:stop]
+
+    def __getitem__(self, key):
+        """
+        Index as a (channels, samples) array, e.g. ep[2], ep[[0, 1], 1000:2000]. Returns a numpy array, or a scalar
+        when indexing a single sample of a single channel.
+        """
+        from numpy import ascontiguousarray
+
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        ch, t = key
+
+        if self._channels is not None:
+            result = self._channels[ch, t]
+        else:
+            # only the timepoints in t are read, but every channel of them
+            result = self._raw[t, ch].T
+
+        # ascontiguousarray would turn a scalar into an array of shape (1,)
+        if result.ndim == 0:
+            return result
+        return ascontiguousarray(result)
+
+    def to_dask(self, channels=None, chunk_samples=2 ** 22):
+        """
+        Return the recording as a dask array with shape (channels, samples), chunked along time. With a cache,
+        computing a channel reads only the bytes of that channel.
+
+        channels : int, list of ints or None. Channels to include; defaults to all.
+        """
+        from dask.array import from_array, stack
+
+        if channels is None:
+            channels = list(range(self.num_channels))
+        scalar = isinstance(channels, int)
+        if scalar:
+            channels = [channels]
+
+        if self._channels is not None:
+            result = stack([from_array(self._channels[ch], chunks=chunk_samples) for ch in channels])
+        else:
+            raw = from_array(self._raw, chunks=(chunk_samples, self.num_channels))
+            result = raw[:, channels].T
+
+        return result[0] if scalar else result
+
+
+def _window_thresholds(blocks, scaling, lower_percentile):
+    """
+    Threshold of each row of a 2D array: median + scaling * (median - lower percentile).
+    """
+    from numpy import median, percentile
+
+    med = median(blocks, axis=1)
+    bottom = percentile(blocks, lower_percentile, axis=1)
+    return med + scaling * (med - bottom)
+
+
+def estimate_threshold(signal, window=180000, scaling=1.6, lower_percentile=0.01, sliding=False, step=None):
     """
     Return non-sliding windowed threshold of input ndarray vec.
 
+    The threshold of each window is computed from the samples in that window and applies until the start of the
+    next window. Windows that do not end before the last sample are not evaluated, so the tail of the signal keeps
+    the threshold of the last complete window, and the threshold is 0 if the signal is not longer than one window.
+
     Parameters
     ----------
 
@@ -264,19 +560,186 @@ def estimate_threshold(signal, window=180000, scaling=1.6, lower_percentile=0.01
 
     lower_percentile : float
         Percentile of signal to use when estimating the lower bound of the noise distribution.
+
+    sliding : bool
+        If True, return a sliding threshold instead, estimated from a window centred on each sample. See
+        sliding_threshold.
+
+    step : int or None
+        Only used if sliding is True, see sliding_threshold.
     """
-    from numpy import zeros, percentile, arange, median
+    from numpy import zeros, repeat
+
+    if sliding:
+        return sliding_threshold(signal, window, scaling=scaling, lower_percentile=lower_percentile, step=step)
 
+    window = int(window)
     th = zeros(signal.shape)
-    for t in arange(0, signal.size - window, window):
-        plr = arange(t, min(t + window, signal.size))
-        sig = signal[plr]
-        med = median(sig)
-        bottom = percentile(sig, lower_percentile)
-        th[t:] = med + scaling * (med - bottom)
+    n_windows = max(0, -(-(signal.size - window) // window))
+    if n_windows == 0:
+        return th
+
+    # a view with one window per row, so that statistics of all windows are computed in one call
+    span = n_windows * window
+    values = _window_thresholds(signal[:span].reshape(n_windows, window), scaling, lower_percentile)
+    th[:span] = repeat(values, window)
+    th[span:] = values[-1]
 
     return th
 
+
+def sliding_threshold(signal, window=180000, scaling=1.6, lower_percentile=0.01, step=None, batch_size=2 ** 24):
+    """
+    Return a sliding threshold of a 1-dimensional signal, with the definition of estimate_threshold applied to a
+    window centred on each sample. The windowed median and percentile are evaluated exactly every step samples and
+    linearly interpolated in between, so the cost is about window / step times that of estimate_threshold. Windows
+    at the edges of the signal are shifted to lie inside it. An empty signal gives an empty threshold.
+
+    signal : ndarray, 1-dimensional
+
+    window : int
+        Length of the sliding window.
+
+    scaling, lower_percentile : see estimate_threshold
+
+    step : int or None
+        Distance between evaluated windows. Defaults to window // 10.
+
+    batch_size : int
+        Approximate number of samples gathered at once, to bound memory use on long signals.
+    """
+    from numpy import arange, clip, concatenate, interp, zeros
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    if signal.size == 0:
+        return zeros(0)
+
+    window = min(int(window), signal.size)
+    if step is None:
+        step = max(1, window // 10)
+
+    centers = arange(0, signal.size, step)
+    if centers[-1] != signal.size - 1:
+        centers = concatenate([centers, [signal.size - 1]])
+    starts = clip(centers - window // 2, 0, signal.size - window)
+
+    windows = sliding_window_view(signal, window)
+    rows = max(1, batch_size // window)
+    values = concatenate(
+        [
+            _window_thresholds(windows[starts[ind : ind + rows]], scaling, lower_percentile)
+            for ind in range(0, starts.size, rows)
+        ]
+    )
+
+    return interp(arange(signal.size), centers, values)
+
+
+def estimate_swims_chunked(
+    signal,
+    fs=6000,
+    scaling=1.6,
+    chunk_minutes=10,
+    fltch_out=None,
+    thr_out=None,
+    lower_percentile=0.01,
+    peak_order="height",
+):
+    """
+    Estimate swim timing from a raw ephys channel in constant memory, e.g. from a multi-hour recording opened with
+    load(..., memmap=True). The windowed variance, threshold and peaks are computed chunk by chunk and stitched so
+    that the result matches running windowed_variance followed by estimate_swims on the whole channel.
+
+    Returns the sample indices of swim starts and stops, i.e. the nonzero indices of the starts and stops returned by
+    estimate_swims.
+
+    Parameters
+    __________
+
+    signal : numpy array or memmap, 1 dimensional. Raw ephys signal.
+
+    fs : int
+        sampling rate of the data, in Hz
+
+    scaling : float
+        see estimate_threshold
+
+    chunk_minutes : int
+        Length of each chunk in minutes. Chunks hold a whole number of the 1 minute threshold windows.
+
+    fltch_out, thr_out : numpy arrays (e.g. memmaps) with the length of signal, or None. If supplied, the windowed
+    variance and the threshold are written into them.
+
+    lower_percentile : float
+        see estimate_threshold
+
+    peak_order : string
+        see estimate_peaks
+    """
+    from numpy import empty, repeat, concatenate, where, array, diff
+    from scipy.signal import find_peaks
+
+    dead_time = 0.010 * fs
+    inter_swim_min = 0.12 * fs
+    window = int(fs * 60)
+    n_samples = signal.shape[0]
+
+    # thresholds are piecewise constant over windows, which must not straddle chunks
+    chunk_size = window * max(1, int(chunk_minutes))
+
+    th_value = 0.0
+    distance = _peak_distance(dead_time)
+    bursts = []
+
+    # samples (and their thresholds) after the last resolved peak candidate, whose peaks may still be suppressed by
+    # peaks in the next chunk
+    carry_start = 0
+    carry_fltch = empty(0)
+    carry_thr = empty(0)
+
+    # one sample of look-ahead is needed to find peaks at the end of a chunk
+    for start, stop, fltch, _, _ in windowed_variance_chunked(signal, chunk_size=chunk_size, fs=fs, extra=1):
+        size = stop - start
+        # as in estimate_threshold, windows that do not end before the last sample keep the previous value
+        n_windows = min(-(-size // window), max(0, -(-(n_samples - window - start) // window)))
+        span = n_windows * window
+        thr = empty(size)
+        if n_windows > 0:
+            values = _window_thresholds(fltch[:span].reshape(n_windows, window), scaling, lower_percentile)
+            thr[:span] = repeat(values, window)
+            th_value = values[-1]
+        thr[span:] = th_value
+
+        seg = concatenate([carry_fltch, fltch])
+        seg_thr = concatenate([carry_thr, thr])
+        seg_size = stop - carry_start
+        peaks = estimate_peaks(seg, dead_time, order=peak_order)
+
+        if stop == n_samples:
+            resolved = seg_size
+        else:
+            # candidates separated by at least the peak distance cannot suppress each other, so peaks before the
+            # last such gap do not depend on the rest of the recording
+            candidates = find_peaks(seg[: seg_size + 1])[0]
+            gaps = where(diff(candidates) >= distance)[0]
+            resolved = candidates[gaps[-1]] + 1 if gaps.size > 0 else 0
+
+        final = peaks[peaks < resolved]
+        bursts.append(final[seg[final] > seg_thr[final]] + carry_start)
+
+        carry_fltch = seg[resolved:seg_size]
+        carry_thr = seg_thr[resolved:seg_size]
+        carry_start += resolved
+
+        if fltch_out is not None:
+            fltch_out[start:stop] = fltch[:size]
+        if thr_out is not None:
+            thr_out[start:stop] = thr
+
+    bursts = concatenate(bursts) if bursts else array([], dtype="int")
+    return _group_swims(bursts, inter_swim_min)
+
+
 if __name__ == "__main__":
     
     import numpy as np
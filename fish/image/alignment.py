@@ -10,7 +10,11 @@
 # License: MIT
 #
 
+from threading import Lock
+from ..util.instrument import instrumented
 
+
+@instrumented("register")
 def estimate_translation(
     fixed,
     moving,
@@ -65,6 +69,572 @@ def estimate_translation(
     return tx
 
 
+def translation_affine(shifts):
+    """
+    Convert translations into homogeneous affine matrices, using the convention of dipy's AffineMap.affine: the
+    translation maps coordinates in the fixed image to coordinates in the moving image.
+
+    shifts : numpy array with shape (ndim,) or (n, ndim)
+
+    Returns an array with shape (ndim + 1, ndim + 1) or (n, ndim + 1, ndim + 1).
+    """
+    from numpy import asarray, zeros, arange
+
+    shifts = asarray(shifts, dtype="float64")
+    ndim = shifts.shape[-1]
+    affines = zeros((*shifts.shape[:-1], ndim + 1, ndim + 1))
+    affines[..., arange(ndim + 1), arange(ndim + 1)] = 1
+    affines[..., :-1, -1] = shifts
+    return affines
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    """
+    Evaluate the inverse DFT of a batch of arrays on an upsampled grid of region_size points per axis, starting at
+    offsets (one row of offsets per array in the batch), using matrix multiplication instead of zero-padded FFTs.
+
+    data : complex numpy array with shape (n, *shape)
+    region_size : int
+    upsample_factor : int
+    offsets : numpy array with shape (n, ndim)
+    """
+    from numpy import arange, exp, pi, moveaxis
+    from numpy.fft import fftfreq
+
+    ndim = data.ndim - 1
+    # contract the last spatial axis first, as a batched matrix product; each contraction moves the new axis to
+    # position 1
+    for ax in range(ndim - 1, -1, -1):
+        n_items = data.shape[-1]
+        grid = arange(region_size)[None, :] - offsets[:, ax][:, None]
+        kernel = exp((-2j * pi) * grid[:, None, :] * fftfreq(n_items, upsample_factor)[None, :, None])
+        kernel = kernel.astype(data.dtype).reshape((kernel.shape[0],) + (1,) * (data.ndim - 3) + kernel.shape[1:])
+        data = moveaxis(data @ kernel, -1, 1)
+    return data
+
+
+def _hann_windows(shape, starts, widths):
+    """
+    Separable Hann windows over an array of the given shape, one per row of starts and widths. Along each axis a
+    window rises from zero at starts to one and falls back to zero at starts + widths; outside that range it is
+    zero. Axes of length 1 are not windowed.
+
+    shape : tuple of ints
+    starts, widths : numpy arrays with shape (n, ndim)
+
+    Returns a float32 array with shape (n, *shape).
+    """
+    from numpy import ones, arange, cos, clip, pi
+
+    ndim = len(shape)
+    window = ones((starts.shape[0],) + (1,) * ndim, dtype="float32")
+    for ax, size in enumerate(shape):
+        if size == 1:
+            continue
+        width = widths[:, ax][:, None]
+        pos = clip(arange(size)[None, :] - starts[:, ax][:, None], 0, width)
+        profile = (0.5 - 0.5 * cos(2 * pi * pos / width)).astype("float32")
+        window = window * profile.reshape((-1,) + tuple(size if a == ax else 1 for a in range(ndim)))
+    return window
+
+
+class PhaseCorrelation(object):
+
+    """
+    Estimate translations between a fixed reference and many moving images by FFT phase correlation. A coarse
+    estimate from the correlation peak is refined to 1 / upsample_factor of a pixel with a local upsampled DFT
+    around the peak (Guizar-Sicairos et al., 2008). Batches of moving images are transformed with one vectorised
+    FFT call.
+
+    Images are mean subtracted and multiplied by a Hann window, so that image borders do not dominate the
+    correlation. A window that does not move with the image biases the estimate towards zero, so each refinement
+    step windows the reference and the moving images again over the region where they overlap at the current
+    estimate, and re-estimates. The cross-power spectrum is only partially whitened and then low-pass filtered, as
+    full phase normalisation is dominated by noise in the weak high frequencies of smooth images.
+    """
+
+    def __init__(self, reference, upsample_factor=20, smoothing=2.0, n_refine=2, workers=-1):
+        """
+        reference : numpy array, 2D or 3D. The fixed image.
+
+        upsample_factor : int, translations are estimated to within 1 / upsample_factor of a pixel.
+
+        smoothing : float, standard deviation in pixels of the Gaussian low-pass filter applied to the
+        cross-correlation. Larger values are more robust to noise.
+
+        n_refine : int, number of times the images are windowed again at the estimated translation and the
+        translation re-estimated. Each step costs two more FFTs per moving image.
+
+        workers : int, number of threads used by scipy.fft. -1 uses all cores.
+        """
+        from numpy import array, conj, zeros, exp, pi, meshgrid
+        from scipy.fft import fftn, fftfreq
+
+        self.shape = reference.shape
+        self.ndim = reference.ndim
+        self.upsample_factor = upsample_factor
+        self.n_refine = n_refine
+        self.workers = workers
+        self._reference = reference.astype("float32")
+        # the first estimate windows the whole reference, so its FFT is shared by every moving image
+        window = _hann_windows(self.shape, zeros((1, self.ndim)), array([self.shape]))
+        self._reference_fft = conj(fftn(self._apodize(self._reference[None], window)[0], workers=workers))
+        freq_sq = sum(f ** 2 for f in meshgrid(*[fftfreq(n) for n in self.shape], indexing="ij"))
+        self._lowpass = exp(-2 * (pi * smoothing) ** 2 * freq_sq).astype("float32")
+
+    def _apodize(self, images, window):
+        """
+        Subtract the window-weighted mean of each image and multiply by its window.
+        """
+        axes = tuple(range(1, self.ndim + 1))
+        images = images.astype("float32")
+        means = (images * window).sum(axes, keepdims=True) / window.sum(axes, keepdims=True)
+        return (images - means) * window
+
+    def _estimate(self, moving, shifts=None):
+        """
+        One estimate of the translations of a batch of moving images. If shifts is None, whole images are windowed;
+        otherwise the reference and each moving image are windowed over their overlap at the given translations.
+        """
+        from numpy import abs, unravel_index, array, ceil, fix, round, where, conj, maximum, zeros
+        from scipy.fft import fftn, ifftn
+
+        axes = tuple(range(1, self.ndim + 1))
+        shape = array(self.shape)
+
+        if shifts is None:
+            full = _hann_windows(self.shape, zeros((1, self.ndim)), shape[None])
+            cross_power = fftn(self._apodize(moving, full), axes=axes, workers=self.workers)
+            cross_power *= self._reference_fft
+        else:
+            widths = shape - abs(shifts)
+            moving_windows = _hann_windows(self.shape, maximum(shifts, 0), widths)
+            reference_windows = _hann_windows(self.shape, maximum(-shifts, 0), widths)
+            cross_power = fftn(self._apodize(moving, moving_windows), axes=axes, workers=self.workers)
+            cross_power *= conj(
+                fftn(self._apodize(self._reference[None], reference_windows), axes=axes, workers=self.workers)
+            )
+
+        magnitude = abs(cross_power)
+        # partial whitening sharpens the peak of smooth images, without amplifying the weakest frequencies
+        cross_power /= magnitude + 10 * magnitude.mean(axes, keepdims=True) + 1e-12
+        cross_power *= self._lowpass
+        corr = abs(ifftn(cross_power, axes=axes, workers=self.workers))
+
+        flat = corr.reshape(corr.shape[0], -1)
+        shifts = array(unravel_index(flat.argmax(1), self.shape), dtype="float64").T
+        shifts = where(shifts > shape // 2, shifts - shape, shifts)
+
+        if self.upsample_factor > 1:
+            ups = self.upsample_factor
+            region_size = int(ceil(ups * 1.5))
+            dftshift = fix(region_size / 2.0)
+            shifts = round(shifts * ups) / ups
+            local = _upsampled_dft(
+                conj(cross_power), region_size, ups, dftshift - shifts * ups
+            )
+            local = abs(conj(local)).reshape(local.shape[0], -1)
+            maxima = array(
+                unravel_index(local.argmax(1), (region_size,) * self.ndim), dtype="float64"
+            ).T
+            shifts += (maxima - dftshift) / ups
+
+        return shifts
+
+    def estimate(self, moving):
+        """
+        Estimate the translation of each moving image relative to the reference.
+
+        moving : numpy array with the shape of the reference, or a batch of such arrays stacked along a new first
+        axis.
+
+        Returns an array of translations with shape (ndim,) for a single image or (n, ndim) for a batch.
+        """
+        single = moving.ndim == self.ndim
+        if single:
+            moving = moving[None]
+
+        shifts = self._estimate(moving)
+        for _ in range(self.n_refine):
+            shifts = self._estimate(moving, shifts)
+
+        if single:
+            return shifts[0]
+        return shifts
+
+    def estimate_affine(self, moving):
+        """
+        Like estimate, but return homogeneous affine matrices with the same shape and convention as the affine
+        attribute of the result of estimate_translation.
+        """
+        return translation_affine(self.estimate(moving))
+
+
+@instrumented("register")
+def estimate_translation_fft(fixed, moving, upsample_factor=20, batch_size=256, workers=-1):
+    """
+    Estimate translation between 2D or 3D images using FFT phase correlation with sub-pixel refinement. This is a
+    fast alternative to estimate_translation.
+
+    fixed : numpy array, 2D or 3D
+        The reference image.
+
+    moving : numpy array with the shape of fixed, or a stack of such images along a new first axis.
+        The image(s) to be transformed.
+
+    upsample_factor : int
+        Translations are estimated to within 1 / upsample_factor of a pixel.
+
+    batch_size : int
+        Number of moving images to transform per FFT call.
+
+    workers : int
+        Number of threads used by scipy.fft. -1 uses all cores.
+
+    Returns the affine matrix (ndim + 1, ndim + 1) for a single moving image, or an array of affine matrices
+    (n, ndim + 1, ndim + 1) for a stack, using the same convention as estimate_translation(...).affine.
+    """
+    from numpy import concatenate
+
+    pc = PhaseCorrelation(fixed, upsample_factor=upsample_factor, workers=workers)
+
+    if moving.ndim == fixed.ndim:
+        return pc.estimate_affine(moving)
+
+    return concatenate(
+        [
+            pc.estimate_affine(moving[ind : ind + batch_size])
+            for ind in range(0, moving.shape[0], batch_size)
+        ]
+    )
+
+
+def _file_key(fname):
+    """
+    Identify a file by its absolute path, size and modification time, so cached results are invalidated when the
+    file changes.
+    """
+    from os.path import abspath
+    from os import stat
+
+    st = stat(fname)
+    return "{0}:{1}:{2}".format(abspath(fname), st.st_size, st.st_mtime_ns)
+
+
+def _params_key(reference, params):
+    """
+    Hash a reference image and a dict of registration parameters into a short string.
+    """
+    from hashlib import sha1
+    import json
+
+    h = sha1()
+    h.update(json.dumps(params, sort_keys=True).encode())
+    h.update(str((reference.shape, reference.dtype.str)).encode())
+    h.update(reference.tobytes())
+    return h.hexdigest()[:16]
+
+
+class RegistrationCache(object):
+
+    """
+    Store per-timepoint affine transforms on disk in a JSON file, keyed by file identity (path, size and
+    modification time). Each combination of reference image and registration parameters gets its own file, so
+    changing either never returns stale transforms.
+    """
+
+    def __init__(self, cache_dir, reference, params):
+        from os.path import join, exists
+        from os import makedirs
+        import json
+
+        if not exists(cache_dir):
+            makedirs(cache_dir)
+
+        self.params = params
+        self.path = join(cache_dir, "regparams_{0}.json".format(_params_key(reference, params)))
+        self.transforms = {}
+
+        if exists(self.path):
+            with open(self.path, "r") as f:
+                self.transforms = json.load(f)["transforms"]
+
+    def __contains__(self, key):
+        return key in self.transforms
+
+    def __getitem__(self, key):
+        from numpy import array
+
+        return array(self.transforms[key])
+
+    def update(self, keys, affines):
+        for k, a in zip(keys, affines):
+            self.transforms[k] = a.tolist()
+
+    def save(self):
+        from os import replace
+        import json
+
+        # write to a temporary file first so an interrupted save never corrupts the cache
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(params=self.params, transforms=self.transforms), f)
+        replace(tmp_path, self.path)
+
+
+def register_timeseries(
+    dset,
+    reference=None,
+    cache_dir=None,
+    method="dipy",
+    proj_axis=0,
+    upsample_factor=20,
+    batch_size=64,
+    scheduler=None,
+):
+    """
+    Estimate translations between every timepoint of an experiment and a reference, in parallel with dask.
+    Per-timepoint transforms are cached on disk, keyed by file identity and registration parameters, so extending
+    an experiment or re-running with the same settings only registers the timepoints that are missing.
+
+    Returns an array of affine matrices, one per timepoint, with the convention of estimate_translation(...).affine.
+
+    dset : ZDS. A ZDS created with single_plane=True is reshaped back to one volume per file.
+
+    reference : numpy array or None. The reference volume. If None, the mean of the 10 timepoints in the middle of
+    the experiment is used. With a cache_dir, that reference is saved as reference.npy in cache_dir and reused by
+    later runs, so that it does not change when the experiment grows.
+
+    cache_dir : string or None. Directory for cached transforms. If None, nothing is cached.
+
+    method : string, 'dipy' for estimate_translation, or 'fft' for the faster estimate_translation_fft.
+
+    proj_axis : int or None. If not None, register max projections along this axis of each volume instead of
+    full volumes.
+
+    upsample_factor : int. Sub-pixel precision of the 'fft' method.
+
+    batch_size : int. Number of timepoints registered per task. The cache is written after each round of tasks.
+
+    scheduler : passed to dask.compute, e.g. 'threads', 'processes', or None to use the default or active
+    distributed client.
+
+    """
+    from numpy import arange, array, load, save
+    from os import makedirs, replace
+    from os.path import join, exists
+    from dask import delayed, compute
+
+    if method not in ("fft", "dipy"):
+        raise ValueError("method must be 'fft' or 'dipy'")
+
+    data = dset.data
+    # a ZDS created with single_plane=True has one entry per plane; register whole volumes, one per file
+    if data.shape[0] != len(dset.files):
+        data = data.reshape(len(dset.files), -1, *data.shape[-2:])
+
+    reference_path = None if cache_dir is None else join(cache_dir, "reference.npy")
+    if reference is None and reference_path is not None and exists(reference_path):
+        # reuse the reference chosen by an earlier run, so that extending the experiment keeps the cache valid
+        reference = load(reference_path)
+    if reference is None:
+        ref_range = arange(-5, 5) + data.shape[0] // 2
+        reference = data[ref_range].mean(0).compute()
+        if reference_path is not None:
+            if not exists(cache_dir):
+                makedirs(cache_dir)
+            tmp_path = reference_path + ".tmp.npy"
+            save(tmp_path, reference)
+            replace(tmp_path, reference_path)
+    reference = reference.astype("float32")
+
+    if proj_axis is not None:
+        reference = reference.max(proj_axis)
+
+    params = dict(method=method, proj_axis=proj_axis, upsample_factor=upsample_factor)
+    keys = [_file_key(f) for f in dset.files]
+
+    cache = None
+    if cache_dir is not None:
+        cache = RegistrationCache(cache_dir, reference, params)
+        missing = [ind for ind, k in enumerate(keys) if k not in cache]
+    else:
+        missing = list(range(len(keys)))
+
+    def register_batch(block):
+        if proj_axis is not None:
+            block = block.max(proj_axis + 1)
+        if method == "fft":
+            return estimate_translation_fft(reference, block, upsample_factor=upsample_factor)
+        return array([estimate_translation(reference, v.astype("float32")).affine for v in block])
+
+    results = {}
+    # register in rounds so that progress is saved to the cache regularly
+    round_size = batch_size * 16
+    for start in range(0, len(missing), round_size):
+        todo = missing[start : start + round_size]
+        batches = [todo[ind : ind + batch_size] for ind in range(0, len(todo), batch_size)]
+        tasks = [delayed(register_batch)(data[b]) for b in batches]
+        for b, affines in zip(batches, compute(*tasks, scheduler=scheduler)):
+            results.update(zip(b, affines))
+            if cache is not None:
+                cache.update([keys[ind] for ind in b], affines)
+        if cache is not None:
+            cache.save()
+
+    return array(
+        [results[ind] if ind in results else cache[keys[ind]] for ind in range(len(keys))]
+    )
+
+
+def register_planes(
+    dset,
+    reference=None,
+    upsample_factor=20,
+    medfilt_window=200,
+    batch_size=64,
+    scheduler=None,
+):
+    """
+    Estimate a separate 2D translation for every z-plane of every timepoint, for data with plane-dependent drift.
+    Planes are registered in parallel with dask using FFT phase correlation; the FFT of each reference plane is
+    computed once and reused by every task for that plane. The translations of each plane are then smoothed over
+    time with a median filter, as in save_dff.motion_correction.
+
+    Returns an array with shape (T, Z, 2) of (y, x) translations of each plane relative to the reference, with the
+    convention of estimate_translation. To correct the data, pass the negated table to
+    fish.image.transform.shift_timeseries.
+
+    dset : ZDS, or numpy or dask array with shape (T, Z, Y, X). A ZDS created with single_plane=True is reshaped
+    back to (T, Z, Y, X).
+
+    reference : numpy array with shape (Z, Y, X) or None. If None, the mean of the 10 timepoints in the middle of
+    the experiment is used.
+
+    upsample_factor : int. Translations are estimated to within 1 / upsample_factor of a pixel.
+
+    medfilt_window : int or None. Size of the temporal median filter applied to the translations. None or 1
+    disables smoothing.
+
+    batch_size : int. Number of timepoints of one plane registered per task.
+
+    scheduler : passed to dask.compute.
+
+    """
+    from numpy import arange, zeros
+    from scipy.ndimage import median_filter
+    from dask import delayed, compute
+    from dask.array import from_array
+    from dask.array.core import Array as DaskArray
+    from .zds import ZDS
+
+    if isinstance(dset, ZDS):
+        data = dset.data
+        if data.shape[0] != len(dset.files):
+            data = data.reshape(len(dset.files), -1, *data.shape[-2:])
+    else:
+        data = dset
+
+    if not isinstance(data, DaskArray):
+        data = from_array(data, chunks=(batch_size, 1, *data.shape[2:]))
+
+    n_time, n_planes = data.shape[:2]
+
+    if reference is None:
+        ref_range = arange(-5, 5) + n_time // 2
+        reference = data[ref_range].mean(0).compute()
+
+    def estimate(pc, block):
+        return pc.estimate(block)
+
+    correlators = [
+        delayed(PhaseCorrelation)(reference[z], upsample_factor=upsample_factor, workers=1)
+        for z in range(n_planes)
+    ]
+
+    tasks = []
+    indices = []
+    for z in range(n_planes):
+        for t0 in range(0, n_time, batch_size):
+            t1 = min(t0 + batch_size, n_time)
+            tasks.append(delayed(estimate)(correlators[z], data[t0:t1, z]))
+            indices.append((slice(t0, t1), z))
+
+    shifts = zeros((n_time, n_planes, 2))
+    for ind, result in zip(indices, compute(*tasks, scheduler=scheduler)):
+        shifts[ind] = result
+
+    if medfilt_window is not None and medfilt_window > 1:
+        shifts = median_filter(shifts, size=(medfilt_window, 1, 1))
+
+    return shifts
+
+
+# serialises _ScaleSpaceCache, which patches a module shared by all threads
+_scale_space_lock = Lock()
+
+
+class _ScaleSpaceCache(object):
+
+    """
+    Context manager that memoizes the Gaussian scale spaces built by dipy's AffineRegistration, so that successive
+    calls to AffineRegistration.optimize with the same images (e.g. translation, rigid and affine stages) build each
+    pyramid only once. Scale spaces are matched on their input image and construction arguments. This patches
+    dipy.align.imaffine while active, so a module-level lock is held from enter to exit: threads using the cache
+    run one at a time, and the patch is always undone by the thread that applied it.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._originals = {}
+
+    def _key(self, args, kwargs):
+        from numpy import ndarray
+
+        def freeze(v):
+            if isinstance(v, ndarray):
+                return (v.shape, v.dtype.str, v.tobytes())
+            if isinstance(v, (list, tuple)):
+                return tuple(freeze(x) for x in v)
+            return v
+
+        return freeze(args), tuple(sorted((k, freeze(v)) for k, v in kwargs.items()))
+
+    def _wrap(self, cls):
+        from numpy import array_equal
+
+        def build(image, *args, **kwargs):
+            key = (cls.__name__, self._key(args, kwargs))
+            for k, im, ss in self._entries:
+                if k == key and im.shape == image.shape and array_equal(im, image):
+                    return ss
+            ss = cls(image, *args, **kwargs)
+            self._entries.append((key, image, ss))
+            return ss
+
+        return build
+
+    def __enter__(self):
+        import dipy.align.imaffine as imaffine
+
+        _scale_space_lock.acquire()
+        for name in ("ScaleSpace", "IsotropicScaleSpace"):
+            if hasattr(imaffine, name):
+                self._originals[name] = getattr(imaffine, name)
+                setattr(imaffine, name, self._wrap(self._originals[name]))
+        return self
+
+    def __exit__(self, *exc):
+        import dipy.align.imaffine as imaffine
+
+        for name, cls in self._originals.items():
+            setattr(imaffine, name, cls)
+        self._originals = {}
+        self._entries = []
+        _scale_space_lock.release()
+        return False
+
+
 class SYNreg(object):
 
     """
@@ -92,6 +662,8 @@ class SYNreg(object):
         self.level_iters_syn = level_iters_syn
         self.ss_sigma_factor = ss_sigma_factor
         self.verbosity = verbosity
+        self.metric_lin = metric_lin
+        self.metric_syn = metric_syn
         if metric_lin is None:
             nbins = 32
             self.metric_lin = MutualInformationMetric(nbins, None)
@@ -104,8 +676,18 @@ class SYNreg(object):
         self.rigid_tx = None
         self.affine_tx = None
         self.sdr_tx = None
+        self._sampling_grids = {}
 
     def generate_warp_field(self, static, moving, static_axis_units, moving_axis_units):
+        """
+        Estimate translation, rigid, affine and diffeomorphic transforms from moving to static, in that order. The
+        Gaussian pyramids of static and moving are built once and shared by the three linear stages.
+
+        The pyramids are shared by temporarily patching dipy.align.imaffine, under a lock, so the linear stages of
+        calls from several threads (e.g. the dask threaded scheduler) run one at a time; use processes for parallel
+        registration. Other code calling dipy's AffineRegistration from another thread at the same time would also
+        see the patch.
+        """
         from numpy import eye
         from dipy.align.imaffine import AffineRegistration
         from dipy.align.transforms import (
@@ -137,35 +719,38 @@ class SYNreg(object):
             ss_sigma_factor=self.ss_sigma_factor,
         )
 
-        self.translation_tx = self.affreg.optimize(
-            static,
-            moving,
-            TranslationTransform3D(),
-            params0,
-            static_g2w,
-            moving_g2w,
-            starting_affine="mass",
-        )
+        self._sampling_grids = {}
 
-        self.rigid_tx = self.affreg.optimize(
-            static,
-            moving,
-            RigidTransform3D(),
-            params0,
-            static_g2w,
-            moving_g2w,
-            starting_affine=self.translation_tx.affine,
-        )
+        with _ScaleSpaceCache():
+            self.translation_tx = self.affreg.optimize(
+                static,
+                moving,
+                TranslationTransform3D(),
+                params0,
+                static_g2w,
+                moving_g2w,
+                starting_affine="mass",
+            )
 
-        self.affine_tx = self.affreg.optimize(
-            static,
-            moving,
-            AffineTransform3D(),
-            params0,
-            static_g2w,
-            moving_g2w,
-            starting_affine=self.rigid_tx.affine,
-        )
+            self.rigid_tx = self.affreg.optimize(
+                static,
+                moving,
+                RigidTransform3D(),
+                params0,
+                static_g2w,
+                moving_g2w,
+                starting_affine=self.translation_tx.affine,
+            )
+
+            self.affine_tx = self.affreg.optimize(
+                static,
+                moving,
+                AffineTransform3D(),
+                params0,
+                static_g2w,
+                moving_g2w,
+                starting_affine=self.rigid_tx.affine,
+            )
 
         self.sdr_tx = self.sdreg.optimize(
             static, moving, static_g2w, moving_g2w, self.affine_tx.affine
@@ -173,27 +758,191 @@ class SYNreg(object):
 
     def apply_transform(self, moving, moving_axis_units, desired_transform):
         from numpy import eye
-        from numpy.linalg import inv
 
         moving_g2w = eye(1 + moving.ndim)
         moving_g2w[range(moving.ndim), range(moving.ndim)] = moving_axis_units
 
+        return self._transform(
+            moving, moving_g2w, moving.shape, moving_g2w, desired_transform
+        )
+
+    def _transform(self, image, image_g2w, out_shape, out_g2w, desired_transform):
+        from numpy.linalg import inv
+
         txs = dict(affine=self.affine_tx, sdr=self.sdr_tx)
         tx = txs[desired_transform]
 
         if desired_transform == "sdr":
             result = tx.transform(
-                moving,
-                image_world2grid=inv(moving_g2w),
-                out_shape=moving.shape,
-                out_grid2world=moving_g2w,
+                image,
+                image_world2grid=inv(image_g2w),
+                out_shape=out_shape,
+                out_grid2world=out_g2w,
             )
         else:
             result = tx.transform(
-                moving,
-                image_grid2world=moving_g2w,
-                sampling_grid_shape=moving.shape,
-                sampling_grid2world=moving_g2w,
+                image,
+                image_grid2world=image_g2w,
+                sampling_grid_shape=out_shape,
+                sampling_grid2world=out_g2w,
             )
 
         return result
+
+    def get_sampling_grid(self, shape, moving_axis_units, desired_transform, pad=2):
+        """
+        Return the coordinates in the moving image sampled by apply_transform for every output voxel, as an array
+        with shape (ndim, *shape). Grids are computed once per (shape, axis units, transform) and reused.
+
+        The grid is found by transforming images of the voxel coordinates themselves: linear interpolation of a linear
+        function is exact. The coordinate images are padded by pad voxels so that coordinates near the edges of the
+        moving image are exact too; output voxels that sample beyond the padding get coordinates outside the image.
+        """
+        from numpy import indices, ones, eye, stack, array
+
+        key = (tuple(shape), tuple(moving_axis_units), desired_transform)
+        if key not in self._sampling_grids:
+            ndim = len(shape)
+            out_g2w = eye(1 + ndim)
+            out_g2w[range(ndim), range(ndim)] = moving_axis_units
+
+            # the padded coordinate images are offset by pad voxels relative to the moving grid
+            padded_g2w = out_g2w.copy()
+            padded_g2w[:-1, -1] = -pad * array(moving_axis_units, dtype="float64")
+            padded_shape = tuple(s + 2 * pad for s in shape)
+
+            coords = indices(padded_shape, dtype="float32") - pad
+            grid = stack(
+                [
+                    self._transform(c, padded_g2w, shape, out_g2w, desired_transform)
+                    for c in coords
+                ]
+            ).astype("float32")
+            coverage = self._transform(
+                ones(padded_shape, dtype="float32"), padded_g2w, shape, out_g2w, desired_transform
+            )
+            grid[:, coverage < (1 - 1e-4)] = -pad
+            self._sampling_grids[key] = grid
+
+        return self._sampling_grids[key]
+
+    def apply_transform_timeseries(
+        self, data, moving_axis_units, desired_transform, order=1
+    ):
+        """
+        Apply a fitted transform to every volume of a time series, using a sampling grid computed once. Returns a
+        lazy dask array of float32 volumes with the shape of data.
+
+        data : numpy or dask array with shape (T, z, y, x)
+
+        moving_axis_units : the axis units used for the moving images in generate_warp_field
+
+        desired_transform : string, 'affine' or 'sdr'
+
+        order : int, interpolation order passed to scipy.ndimage.map_coordinates. 1 matches apply_transform.
+        """
+        from scipy.ndimage import map_coordinates
+        from dask.array import from_array
+        from dask.array.core import Array as DaskArray
+
+        if not isinstance(data, DaskArray):
+            data = from_array(data, chunks=(1, *data.shape[1:]))
+        data = data.rechunk({ax: -1 for ax in range(1, data.ndim)})
+
+        grid = self.get_sampling_grid(data.shape[1:], moving_axis_units, desired_transform)
+
+        def warp_block(block):
+            result = block.astype("float32")
+            for ind, vol in enumerate(result):
+                result[ind] = map_coordinates(
+                    vol, grid, order=order, mode="grid-constant", cval=0, prefilter=order > 1
+                )
+            return result
+
+        return data.map_blocks(warp_block, dtype="float32")
+
+    def save(self, path):
+        """
+        Save the fitted affine and diffeomorphic maps to a .npz file.
+        """
+        from numpy import savez, array
+
+        state = {}
+        for name in ("translation_tx", "rigid_tx", "affine_tx"):
+            tx = getattr(self, name)
+            if tx is None:
+                continue
+            state[name + "/affine"] = tx.affine
+            for attr in ("domain_shape", "domain_grid2world", "codomain_shape", "codomain_grid2world"):
+                value = getattr(tx, attr)
+                if value is not None:
+                    state[name + "/" + attr] = array(value)
+
+        if self.sdr_tx is not None:
+            for attr in (
+                "dim",
+                "disp_shape",
+                "disp_grid2world",
+                "domain_shape",
+                "domain_grid2world",
+                "codomain_shape",
+                "codomain_grid2world",
+                "prealign",
+                "is_inverse",
+                "forward",
+                "backward",
+            ):
+                value = getattr(self.sdr_tx, attr)
+                if value is not None:
+                    state["sdr_tx/" + attr] = array(value)
+
+        savez(path, **state)
+
+    def load(self, path):
+        """
+        Load affine and diffeomorphic maps saved with SYNreg.save, replacing any fitted maps.
+        """
+        from numpy import load
+        from dipy.align.imaffine import AffineMap
+        from dipy.align.imwarp import DiffeomorphicMap
+
+        with load(path) as f:
+            state = {k: f[k] for k in f.files}
+
+        def get(name, attr):
+            return state.get(name + "/" + attr)
+
+        for name in ("translation_tx", "rigid_tx", "affine_tx"):
+            if get(name, "affine") is None:
+                setattr(self, name, None)
+                continue
+            setattr(
+                self,
+                name,
+                AffineMap(
+                    get(name, "affine"),
+                    domain_grid_shape=get(name, "domain_shape"),
+                    domain_grid2world=get(name, "domain_grid2world"),
+                    codomain_grid_shape=get(name, "codomain_shape"),
+                    codomain_grid2world=get(name, "codomain_grid2world"),
+                ),
+            )
+
+        self.sdr_tx = None
+        if get("sdr_tx", "forward") is not None:
+            self.sdr_tx = DiffeomorphicMap(
+                int(get("sdr_tx", "dim")),
+                get("sdr_tx", "disp_shape"),
+                disp_grid2world=get("sdr_tx", "disp_grid2world"),
+                domain_shape=get("sdr_tx", "domain_shape"),
+                domain_grid2world=get("sdr_tx", "domain_grid2world"),
+                codomain_shape=get("sdr_tx", "codomain_shape"),
+                codomain_grid2world=get("sdr_tx", "codomain_grid2world"),
+                prealign=get("sdr_tx", "prealign"),
+            )
+            self.sdr_tx.is_inverse = bool(get("sdr_tx", "is_inverse"))
+            self.sdr_tx.forward = get("sdr_tx", "forward")
+            self.sdr_tx.backward = get("sdr_tx", "backward")
+
+        self._sampling_grids = {}
+        return self
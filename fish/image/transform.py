@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+#  Tools for applying translations to images, e.g. to correct motion
+#
+# Davis Bennett
+# davis.v.bennett@gmail.com
+#
+# License: MIT
+#
+
+
+def _shift_integer(src, dst, shift, cval=0):
+    """
+    Copy src into dst translated by an integer number of pixels along each axis, filling uncovered pixels with cval.
+    Follows the convention of scipy.ndimage.shift: dst[x] = src[x - shift].
+    """
+    src_slices = []
+    dst_slices = []
+    for size, s in zip(src.shape, shift):
+        s = int(s)
+        if s >= 0:
+            src_slices.append(slice(0, max(size - s, 0)))
+            dst_slices.append(slice(min(s, size), size))
+        else:
+            src_slices.append(slice(min(-s, size), size))
+            dst_slices.append(slice(0, max(size + s, 0)))
+
+    src_slices = tuple(src_slices)
+    dst_slices = tuple(dst_slices)
+    # copy first, in case src and dst share memory
+    valid = src[src_slices].copy()
+    dst[...] = cval
+    dst[dst_slices] = valid
+    return dst
+
+
+def _shift_linear(image, shift, cval=0):
+    """
+    Translate an image by a real-valued shift with separable linear interpolation, one axis at a time. Returns a
+    float32 array.
+    """
+    from numpy import floor, empty
+
+    work = image.astype("float32")
+    for ax, s in enumerate(shift):
+        base = int(floor(s))
+        frac = s - base
+        axis_shift = [0] * image.ndim
+
+        axis_shift[ax] = base
+        lower = _shift_integer(work, empty(work.shape, dtype="float32"), axis_shift, cval)
+        if frac == 0:
+            work = lower
+            continue
+
+        axis_shift[ax] = base + 1
+        upper = _shift_integer(work, empty(work.shape, dtype="float32"), axis_shift, cval)
+        lower *= 1 - frac
+        upper *= frac
+        lower += upper
+        work = lower
+
+    return work
+
+
+def _shift_fft(image, shift, cval=0):
+    """
+    Translate an image by a real-valued shift by multiplying its Fourier transform with a phase ramp. The Fourier
+    shift is circular, so pixels that wrap around the edges are replaced with cval. Returns a float32 array.
+    """
+    from numpy import exp, pi, ceil, floor
+    from scipy.fft import rfftn, irfftn, fftfreq, rfftfreq
+
+    spectrum = rfftn(image.astype("float32"))
+    for ax, s in enumerate(shift):
+        if ax == image.ndim - 1:
+            freqs = rfftfreq(image.shape[ax])
+        else:
+            freqs = fftfreq(image.shape[ax])
+        ramp_shape = [1] * image.ndim
+        ramp_shape[ax] = freqs.size
+        spectrum *= exp(-2j * pi * s * freqs).astype("complex64").reshape(ramp_shape)
+
+    result = irfftn(spectrum, s=image.shape).astype("float32")
+
+    for ax, s in enumerate(shift):
+        slices = [slice(None)] * image.ndim
+        if s > 0:
+            slices[ax] = slice(0, int(ceil(s)))
+        elif s < 0:
+            slices[ax] = slice(image.shape[ax] + int(floor(s)), None)
+        else:
+            continue
+        result[tuple(slices)] = cval
+
+    return result
+
+
+kernels = dict()
+kernels["linear"] = _shift_linear
+kernels["fft"] = _shift_fft
+
+
+def shift_image(image, shift, kernel="linear", out=None, dtype=None, cval=0):
+    """
+    Translate an image, using the same convention as scipy.ndimage.shift: result[x] = image[x - shift].
+
+    image : numpy array
+
+    shift : iterable of floats, one per axis of image.
+
+    kernel : string, one of
+        'integer' : round the shift to whole pixels and copy a cropped view. No interpolation.
+        'linear' : separable linear interpolation in float32.
+        'fft' : sub-pixel shift by a phase ramp in the Fourier domain, in float32.
+
+    out : numpy array or None. If supplied, the result is written into out, which may be image itself. Its dtype
+    sets the output dtype.
+
+    dtype : output dtype when out is None, e.g. 'float32' or 'uint16'. Defaults to the dtype of image. Integer
+    outputs are rounded and clipped to the range of the dtype.
+
+    cval : value used for pixels shifted in from outside the image.
+
+    """
+    from numpy import asarray, rint, iinfo, issubdtype, integer, empty, can_cast, dtype as np_dtype
+
+    if kernel != "integer" and kernel not in kernels:
+        raise ValueError(
+            "Kernel {0} not supported. Use one of {1}".format(
+                kernel, ("integer", *kernels)
+            )
+        )
+
+    shift = asarray(shift, dtype="float64")
+    if shift.size != image.ndim:
+        raise ValueError("shift must have one element per axis of image")
+
+    if out is None:
+        out = empty(image.shape, dtype=image.dtype if dtype is None else np_dtype(dtype))
+
+    if kernel == "integer":
+        # copy straight into out unless values would need rounding or clipping to fit its dtype
+        if not issubdtype(out.dtype, integer) or can_cast(image.dtype, out.dtype, "safe"):
+            return _shift_integer(image, out, rint(shift).astype("int"), cval)
+        result = _shift_integer(image, empty(image.shape, dtype="float64"), rint(shift).astype("int"), cval)
+    else:
+        result = kernels[kernel](image, shift, cval)
+
+    if issubdtype(out.dtype, integer):
+        info = iinfo(out.dtype)
+        rint(result, out=result)
+        result.clip(info.min, info.max, out=result)
+
+    out[...] = result
+    return out
+
+
+def shift_timeseries(data, shifts, kernel="linear", dtype="float32", cval=0):
+    """
+    Translate every image of a time series by its own shift. Dask arrays are processed lazily, one block at a time;
+    numpy arrays are processed immediately.
+
+    data : numpy or dask array with time along the first axis.
+
+    shifts : numpy array with the convention of shift_image. Either (T, data.ndim - 1), one shift per timepoint, or
+    (T, Z, 2) for data with shape (T, Z, Y, X), one 2D shift per plane per timepoint, e.g. the negated output of
+    fish.image.alignment.register_planes.
+
+    kernel : string, see shift_image.
+
+    dtype : output dtype, e.g. 'float32' or 'uint16'.
+
+    cval : value used for pixels shifted in from outside the image.
+
+    """
+    from numpy import asarray, empty
+    from dask.array.core import Array as DaskArray
+
+    shifts = asarray(shifts, dtype="float64")
+    per_plane = shifts.ndim == 3
+    if per_plane:
+        if data.ndim != 4 or shifts.shape != (*data.shape[:2], 2):
+            raise ValueError("Per-plane shifts must have shape (T, Z, 2) for data with shape (T, Z, Y, X)")
+    elif shifts.shape != (data.shape[0], data.ndim - 1):
+        raise ValueError("shifts must have shape (T, data.ndim - 1)")
+
+    def shift_block(block, t0):
+        result = empty(block.shape, dtype=dtype)
+        for ind in range(block.shape[0]):
+            if per_plane:
+                for z in range(block.shape[1]):
+                    shift_image(
+                        block[ind, z], shifts[t0 + ind, z], kernel=kernel, out=result[ind, z], cval=cval
+                    )
+            else:
+                shift_image(block[ind], shifts[t0 + ind], kernel=kernel, out=result[ind], cval=cval)
+        return result
+
+    if isinstance(data, DaskArray):
+        data = data.rechunk({ax: -1 for ax in range(1, data.ndim)})
+        return data.map_blocks(
+            lambda block, block_info=None: shift_block(
+                block, block_info[0]["array-location"][0][0]
+            ),
+            dtype=dtype,
+        )
+
+    return shift_block(data, 0)
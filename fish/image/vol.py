@@ -10,6 +10,8 @@
 # License: MIT
 #
 
+from ..util.instrument import instrumented
+
 
 def local_corr(images, offset=[0, 1, 1]):
     """
@@ -35,6 +37,7 @@ def local_corr(images, offset=[0, 1, 1]):
     return joined.mapValues(lambda v: correlate_signals(v[0], v[1]))
 
 
+@instrumented("baseline")
 def baseline(data, window, percentile, downsample=1, axis=-1):
     """
     Get the baseline of a numpy array using a windowed percentile filter with optional downsampling
@@ -69,8 +72,7 @@ def baseline(data, window, percentile, downsample=1, axis=-1):
         bl = percentile_filter(data, percentile=percentile, size=size)
 
     else:
-        data_ds = data[slices]
-        print('data_ds: ', data_ds.shape)
+        data_ds = data[tuple(slices)]
         baseline_ds = percentile_filter(data_ds, percentile=percentile, size=size)
         interper = interp1d(
             range(0, data.shape[axis], downsample),
@@ -83,6 +85,7 @@ def baseline(data, window, percentile, downsample=1, axis=-1):
     return bl
 
 
+@instrumented("dff")
 def dff(data, window, percentile, baseline_offset, downsample=1, axis=-1):
     """
     Estimate normalized change in fluorescence (dff) with the option to estimate baseline on downsampled data.
@@ -135,20 +138,18 @@ def filter_flat(vol, mask):
 
 def unfilter_flat(vec, mask):
     """
-    Reverse the effect of filter_flat by taking a 1d ndarray and assigning each value to a position in an ndarray
+    Reverse the effect of filter_flat by taking a 1d ndarray and assigning each value to a position in an ndarray.
+    The result has the same dtype as vec.
 
     vec : 1-dimensional ndarray
     mask : binary ndarray
     """
 
-    from numpy import zeros
+    from numpy import zeros, asarray
 
-    """
-    Fill a binary mask with the values in vec
-    """
-    mask_flat = mask.ravel()
-    vol = zeros(mask.shape).ravel()
-    vol[mask_flat == True] = vec
+    vec = asarray(vec)
+    vol = zeros(mask.size, dtype=vec.dtype)
+    vol[asarray(mask, dtype="bool").ravel()] = vec
 
     return vol.reshape(mask.shape)
 
@@ -162,24 +163,25 @@ def kvp_to_array(dims, data, ind=0, baseline=0):
     :param baseline: fill value for empty spots in the volume
     :return: vol, an ndarray
     """
-    from numpy import zeros, array
+    from numpy import full, array
 
-    vol = zeros(dims, dtype=data[0][1].dtype) + array(baseline).astype(data[0][1].dtype)
+    keys, vals = zip(*data)
+    vals = array(vals)
 
-    for k, v in data:
-        # check if data contains a single value or an iterable
-        if hasattr(v, "__iter__"):
-            vol[k] = v[ind]
-        else:
-            vol[k] = v
+    # check if data contains a single value or an iterable
+    if vals.ndim > 1:
+        vals = vals[:, ind]
+
+    vol = full(dims, baseline, dtype=vals.dtype)
+    vol[tuple(array(keys).reshape(len(keys), -1).T)] = vals
     return vol
 
 
 def sub_proj(im, ax, func, chop=16):
     """
-    Project a volume in chunks along an axis.
+    Project a volume in chunks along an axis. The input is not modified.
 
-    im : numpy array, data to be projected
+    im : numpy or dask array, data to be projected
 
     ax : int, axis to project along
 
@@ -188,7 +190,11 @@ def sub_proj(im, ax, func, chop=16):
     chop : int, number of projections to generate
 
     """
-    from numpy import rollaxis
+    from numpy import rollaxis, concatenate
+    from dask.array.core import Array as DaskArray
+
+    if isinstance(im, DaskArray):
+        from dask.array import concatenate, rollaxis
 
     extra = im.shape[ax] % chop
     montage_dims = list(im.shape)
@@ -198,19 +204,103 @@ def sub_proj(im, ax, func, chop=16):
     slices_crop = [slice(None) for x in im.shape]
     slices_crop[ax] = slice(0, extra + 1, 1)
 
-    # remove trailing data by projecting it down to a single plane
-    im[slices_crop] = im[slices_crop].max(ax, keepdims=True)
-
     slices_keep = [slice(None) for x in im.shape]
-    slices_keep[ax] = slice(extra, None)
+    slices_keep[ax] = slice(extra + 1, None)
 
-    im_proj = func(im[slices_keep].reshape(montage_dims), axis=ax + 1)
+    # remove trailing data by projecting it down to a single plane
+    im_cropped = concatenate(
+        [im[tuple(slices_crop)].max(ax, keepdims=True), im[tuple(slices_keep)]], axis=ax
+    )
+
+    im_proj = func(im_cropped.reshape(montage_dims), axis=ax + 1)
     # stick the axis of projections in the front
     im_proj = rollaxis(im_proj, ax, 0)
 
     return im_proj
 
 
+def _chop_bounds(length, chop):
+    """
+    Split range(length) into chop contiguous groups of equal size. Leftover elements are added to the first group.
+    Returns a list of (start, stop) tuples.
+    """
+    size = length // chop
+    extra = length % chop
+    starts = [0] + [extra + size * ind for ind in range(1, chop)]
+    stops = starts[1:] + [length]
+    return list(zip(starts, stops))
+
+
+def project(data, reducers=("max",), axes=(0,), chop=None, compute=False):
+    """
+    Compute several projections of an array. For each axis in axes and each reducer in reducers, the data are
+    reduced along that axis, optionally in chop contiguous sub-projections. The input is not modified. Dask inputs
+    are read in one pass when the projections are computed together (see compute); for numpy inputs each reducer is
+    a separate numpy reduction over the array in memory.
+
+    Returns a dict mapping (reducer, axis) to the projection. If chop is None the projected axis is removed;
+    otherwise a new leading axis of length chop indexes the sub-projections, as in sub_proj.
+
+    data : numpy or dask array
+
+    reducers : iterable of strings, any of 'max', 'min', 'mean', 'std', 'argmax'. Indices returned by 'argmax'
+    refer to positions along the full axis.
+
+    axes : iterable of ints, axes to project along.
+
+    chop : int or None, number of sub-projections to generate along each axis. If the length of the axis is not
+    divisible by chop, the leftover elements are included in the first sub-projection.
+
+    compute : bool, if True and data is a dask array, all projections are computed together so that the
+    underlying data are read only once. Otherwise dask inputs produce lazy dask arrays, which should be passed
+    together to dask.compute to share the read.
+
+    """
+    from numpy import stack
+    from dask.array.core import Array as DaskArray
+
+    supported = ("max", "min", "mean", "std", "argmax")
+    for r in reducers:
+        if r not in supported:
+            raise ValueError(
+                "Reducer {0} not supported. Use one of {1}".format(r, supported)
+            )
+
+    is_dask = isinstance(data, DaskArray)
+    if is_dask:
+        from dask.array import stack
+
+    results = {}
+    for ax in axes:
+        ax = ax % data.ndim
+        bounds = [(0, data.shape[ax])] if chop is None else _chop_bounds(data.shape[ax], chop)
+        projections = {r: [] for r in reducers}
+
+        for start, stop in bounds:
+            slices = [slice(None)] * data.ndim
+            slices[ax] = slice(start, stop)
+            group = data[tuple(slices)]
+
+            for r in reducers:
+                proj = getattr(group, r)(axis=ax)
+                if r == "argmax":
+                    proj = proj + start
+                projections[r].append(proj)
+
+        for r in reducers:
+            if chop is None:
+                results[(r, ax)] = projections[r][0]
+            else:
+                results[(r, ax)] = stack(projections[r])
+
+    if compute and is_dask:
+        from dask import compute as dask_compute
+
+        results = dask_compute(results)[0]
+
+    return results
+
+
 def redim(array, ndim, shape=None):
     """
     Add or remove trailing dimensions from an array by reshaping. Useful for turning N-dimensional data into the 2D
@@ -262,6 +352,11 @@ class InterpArray:
 
         full_shape: the full shape of the data that generated x. If x was generated by some larger numpy array z,
         then x == z[y], and full_shape == z.shape
+
+        interpolation_axis: int, the axis of y that corresponds to x.
+
+        Indices that fall before the first or after the last sampled point take the value of the nearest sample. If y
+        is a dask array, the result is a lazy dask array with one interpolation task per block of y.
         """
         from numpy import array
 
@@ -284,8 +379,29 @@ class InterpArray:
 
         return arange(self.full_shape[axis])[slc]
 
+    def _get_brackets(self, idx_interp):
+        """
+        For each index in ``idx_interp``, find the pair of keyframes that bracket it and the linear interpolation
+        weight of the upper keyframe. Indices before the first keyframe or after the last keyframe are assigned to the
+        nearest keyframe.
+        """
+        from numpy import searchsorted, clip, where
+
+        last = len(self.x) - 1
+        upper = searchsorted(self.x, idx_interp, side="left")
+        lower = clip(upper - 1, 0, last)
+        upper = clip(upper, 0, last)
+
+        interval = self.x[upper] - self.x[lower]
+        # lower == upper only at the edges, where the weight is irrelevant
+        safe_interval = where(interval == 0, 1, interval)
+        weight = where(interval == 0, 0.0, (idx_interp - self.x[lower]) / safe_interval)
+
+        return lower, upper, weight
+
     def _get_interpolated_value(self, idx):
-        from numpy import where, diff, array
+        from numpy import asarray, unique, concatenate, searchsorted, result_type, integer
+        from dask.array.core import Array as DaskArray
 
         ipax = self.interpolation_axis
 
@@ -294,63 +410,54 @@ class InterpArray:
         except TypeError:
             idx_ = [idx]
 
-        idx_interp = idx_[ipax]
+        idx_interp = asarray(idx_[ipax])
+        scalar = idx_interp.ndim == 0
+        idx_interp = idx_interp.ravel()
 
-        # if hasattr(idx_interp, '__getitem__'):
-        # make dists a column vector so we can potentially subtract a row vector
-        dists = self.x.reshape(-1, 1) - idx_interp
-        result = []
+        lower, upper, weight = self._get_brackets(idx_interp)
 
-        for d_ in dists.T:
-            idx_inner = idx_
-            ds_ind_pre = where(d_ >= 0)[0][0] - 1
+        # gather every keyframe we need with a single indexed read of y
+        needed = unique(concatenate([lower, upper]))
+        idx_inner = list(idx_)
+        idx_inner[ipax] = needed
+        y_ = self.y[tuple(idx_inner)]
 
-            if ds_ind_pre == -1:
-                idx_inner[ipax] = 0
-                result.append(self.y[tuple(idx_inner)])
-                continue
-
-            interval = diff(self.x)[ds_ind_pre]
-            coeffs = (
-                array([interval - abs(d_[ds_ind_pre]), abs(d_[ds_ind_pre])]) / interval
-            )
-
-            idx_inner[ipax] = slice(ds_ind_pre, ds_ind_pre + 2)
-
-            # non-slice indices (ints) will drop an axis
-            keep_axes = [
-                ind
-                for ind in range(len(idx_inner))
-                if isinstance(idx_inner[ind], slice)
-            ]
-
-            y_ = self.y[tuple(idx_inner)]
-
-            new_coeff_shape = [1] * y_.ndim
-            new_coeff_shape[keep_axes.index(ipax)] = coeffs.size
-
-            # perform linear interpolation
-            result.append(
-                (coeffs.reshape(new_coeff_shape) * y_).sum(keep_axes.index(ipax))
-            )
-
-        return self._concat_arrays(result)
+        # integer indices drop an axis, so find where the interpolation axis ends up in y_
+        out_axis = sum(
+            1 for ind in idx_inner[:ipax] if not isinstance(ind, (int, integer))
+        )
+        lower = searchsorted(needed, lower)
+        upper = searchsorted(needed, upper)
+
+        dtype = result_type(y_.dtype, "float32")
+        weight = weight.astype(dtype)
+
+        def interpolate(block):
+            take_lower = [slice(None)] * block.ndim
+            take_upper = [slice(None)] * block.ndim
+            weight_shape = [1] * block.ndim
+            weight_shape[out_axis] = weight.size
+            take_lower[out_axis] = lower
+            take_upper[out_axis] = upper
+            w = weight.reshape(weight_shape)
+            result = (1 - w) * block[tuple(take_lower)] + w * block[tuple(take_upper)]
+            return result.astype(dtype)
+
+        if isinstance(y_, DaskArray):
+            # keep all keyframes in one chunk so each spatial block is interpolated by a single task
+            y_ = y_.rechunk({out_axis: -1})
+            chunks = list(y_.chunks)
+            chunks[out_axis] = (weight.size,)
+            result = y_.map_blocks(interpolate, chunks=tuple(chunks), dtype=dtype)
+        else:
+            result = interpolate(asarray(y_))
 
-    def _concat_arrays(self, input):
-        from numpy import array
-        from dask.array import stack
-        from dask.array.core import Array as DaskArray
-        from numpy import ndarray as NPArray
+        if scalar:
+            take = [slice(None)] * result.ndim
+            take[out_axis] = 0
+            result = result[tuple(take)]
 
-        if len(input) == 1:
-            return input[0]
-        else:
-            if isinstance(input[0], DaskArray):
-                return stack(input)
-            elif isinstance(input[0], NPArray):
-                return array(input)
-            else:
-                return input
+        return result
 
     def __getitem__(self, idx):
         ipax = self.interpolation_axis
@@ -370,3 +477,795 @@ class InterpArray:
         result = self._get_interpolated_value(idx)
 
         return result
+
+
+def roi_weights(rois, normalize=True):
+    """
+    Build a sparse matrix that maps the flattened voxels of a volume onto a set of regions of interest. Multiplying
+    this matrix with a flattened volume yields one value per ROI. Returns the matrix, with shape (n_rois, n_voxels),
+    and an array with the label of each ROI.
+
+    rois : ndarray of integers or a list of binary ndarrays. An integer ndarray is treated as a label image, where each
+    nonzero value defines one ROI and 0 is background. A list of binary masks (all with the same shape) defines one ROI
+    per mask; masks may overlap.
+
+    normalize : bool, if True (default) the weights of each ROI sum to 1, so that the product with a volume is the mean
+    over the ROI. If False, the product is the sum over the ROI.
+
+    """
+    from numpy import asarray, unique, concatenate, flatnonzero, full, ones, arange, bincount
+    from scipy.sparse import csr_matrix
+
+    if isinstance(rois, (list, tuple)):
+        masks = [asarray(m) for m in rois]
+        n_voxels = masks[0].size
+        cols = [flatnonzero(m) for m in masks]
+        rows = concatenate([full(c.size, ind) for ind, c in enumerate(cols)])
+        cols = concatenate(cols)
+        labels = arange(len(masks))
+    else:
+        label_image = asarray(rois).ravel()
+        n_voxels = label_image.size
+        cols = flatnonzero(label_image)
+        labels, rows = unique(label_image[cols], return_inverse=True)
+
+    vals = ones(cols.size, dtype="float32")
+    if normalize:
+        counts = bincount(rows, minlength=len(labels))
+        vals /= counts[rows]
+
+    weights = csr_matrix((vals, (rows, cols)), shape=(len(labels), n_voxels))
+    return weights, labels
+
+
+def extract_traces(data, rois, normalize=True):
+    """
+    Extract the mean (or summed) time series of many ROIs in one pass over the data. Each chunk of the data is
+    reduced to all of its ROI values with a single sparse matrix multiplication, so the cost of extraction is dominated
+    by reading the data once regardless of the number of ROIs.
+
+    Returns an array with shape (n_rois, T) and an array with the label of each ROI. If data is a dask array or a ZDS,
+    the traces are returned as a lazy dask array; otherwise a numpy array is returned.
+
+    data : numpy array, dask array, or ZDS with time along the first axis.
+
+    rois : label image or list of binary masks with the same shape as data.shape[1:]. See roi_weights.
+
+    normalize : bool, if True (default) compute the mean over each ROI, otherwise compute the sum.
+
+    """
+    from numpy import prod
+    from dask.array.core import Array as DaskArray
+    from .zds import ZDS
+
+    if isinstance(data, ZDS):
+        data = data.data
+
+    weights, labels = roi_weights(rois, normalize=normalize)
+
+    if weights.shape[1] != prod(data.shape[1:]):
+        raise ValueError("ROIs must have the same shape as the non-temporal axes of data.")
+
+    def project(block):
+        # (n_rois, n_voxels) x (n_voxels, t), transposed back to (t, n_rois)
+        return (weights @ block.reshape(block.shape[0], -1).T).T.astype("float32")
+
+    if isinstance(data, DaskArray):
+        # each chunk must span the full volume so that it can be reduced by one matrix multiplication
+        data = data.rechunk({ax: -1 for ax in range(1, data.ndim)})
+        traces = data.map_blocks(
+            project,
+            chunks=(data.chunks[0], (weights.shape[0],)),
+            drop_axis=list(range(2, data.ndim)),
+            dtype="float32",
+        ).T
+    else:
+        traces = project(data).T
+
+    return traces, labels
+
+
+class MaskedVolume:
+    def __init__(self, mask, values=None):
+        """
+        Store a time series of volumes as only the voxels inside a binary mask. Values are kept as a contiguous
+        (T, n_voxels) array in their original dtype, alongside the flat indices of the masked voxels, so that
+        extracting and restoring full volumes is a single vectorised gather / scatter.
+
+        mask : binary ndarray with the shape of a single volume.
+
+        values : numpy or dask array with shape (T, n_voxels), where n_voxels is the number of nonzero elements of
+        mask. May be None, in which case values must be filled later, e.g. via MaskedVolume.from_array.
+        """
+        from numpy import asarray, flatnonzero
+
+        self.mask = asarray(mask, dtype="bool")
+        self.indices = flatnonzero(self.mask)
+        self.values = None
+
+        if values is not None:
+            self.values = self._validate(values)
+
+    @classmethod
+    def from_array(cls, data, mask):
+        """
+        Create a MaskedVolume by gathering the masked voxels of data.
+
+        data : numpy or dask array with shape (T, *mask.shape) or mask.shape. Dask arrays are gathered lazily.
+
+        mask : binary ndarray
+        """
+        result = cls(mask)
+        result.values = result.gather(data)
+        return result
+
+    def _validate(self, values):
+        if values.ndim != 2 or values.shape[1] != self.indices.size:
+            raise ValueError(
+                "values must have shape (T, {0}), got {1}".format(
+                    self.indices.size, values.shape
+                )
+            )
+        return values
+
+    def __repr__(self):
+        return "A masked volume with {0} of {1} voxels and {2} timepoints".format(
+            self.indices.size, self.mask.size, len(self)
+        )
+
+    def __len__(self):
+        return 0 if self.values is None else self.values.shape[0]
+
+    def __getitem__(self, idx):
+        """
+        Index the time axis, returning a new MaskedVolume that shares the mask.
+        """
+        values = self.values[idx]
+        if values.ndim == 1:
+            values = values.reshape(1, -1)
+        result = MaskedVolume.__new__(MaskedVolume)
+        result.mask = self.mask
+        result.indices = self.indices
+        result.values = values
+        return result
+
+    @property
+    def shape(self):
+        """
+        The shape of the full data represented by this object, i.e. (T, *mask.shape)
+        """
+        return (len(self), *self.mask.shape)
+
+    @property
+    def dtype(self):
+        return None if self.values is None else self.values.dtype
+
+    def gather(self, data):
+        """
+        Return the masked voxels of data as a (T, n_voxels) array in the dtype of data.
+
+        data : numpy or dask array with shape (T, *mask.shape) or mask.shape.
+        """
+        from numpy import ascontiguousarray
+        from dask.array.core import Array as DaskArray
+
+        if data.shape == self.mask.shape:
+            data = data.reshape(1, *data.shape)
+
+        if data.shape[1:] != self.mask.shape:
+            raise ValueError("Data must have the same shape as the mask along its trailing axes.")
+
+        indices = self.indices
+
+        def gather_block(block):
+            return ascontiguousarray(block.reshape(block.shape[0], -1)[:, indices])
+
+        if isinstance(data, DaskArray):
+            data = data.rechunk({ax: -1 for ax in range(1, data.ndim)})
+            return data.map_blocks(
+                gather_block,
+                chunks=(data.chunks[0], (indices.size,)),
+                drop_axis=list(range(2, data.ndim)),
+                dtype=data.dtype,
+            )
+
+        return gather_block(data)
+
+    def scatter(self, values=None, fill_value=0):
+        """
+        Return full volumes with shape (T, *mask.shape), filled with values inside the mask and fill_value outside.
+        The dtype of values is preserved. If values is a dask array, the result is a lazy dask array.
+
+        values : numpy or dask array with shape (T, n_voxels). Defaults to the values stored in this object.
+
+        fill_value : scalar used for voxels outside the mask.
+        """
+        from numpy import full
+        from dask.array.core import Array as DaskArray
+
+        if values is None:
+            values = self.values
+        values = self._validate(values)
+
+        indices = self.indices
+        shape = self.mask.shape
+
+        def scatter_block(block):
+            vol = full((block.shape[0], self.mask.size), fill_value, dtype=block.dtype)
+            vol[:, indices] = block
+            return vol.reshape(block.shape[0], *shape)
+
+        if isinstance(values, DaskArray):
+            values = values.rechunk({1: -1})
+            return values.map_blocks(
+                scatter_block,
+                chunks=(values.chunks[0], *((s,) for s in shape)),
+                drop_axis=1,
+                new_axis=list(range(1, len(shape) + 1)),
+                dtype=values.dtype,
+            )
+
+        return scatter_block(values)
+
+    def to_dask(self, chunks="auto"):
+        """
+        Return the stored values as a dask array with shape (T, n_voxels), chunked along time only.
+        """
+        from dask.array import from_array
+        from dask.array.core import Array as DaskArray
+
+        if isinstance(self.values, DaskArray):
+            return self.values.rechunk((chunks, -1))
+        return from_array(self.values, chunks=(chunks, -1))
+
+    def compute(self):
+        """
+        Return a MaskedVolume whose values are a contiguous numpy array, computing them if they are lazy.
+        """
+        from numpy import ascontiguousarray
+        from dask.array.core import Array as DaskArray
+
+        values = self.values
+        if isinstance(values, DaskArray):
+            values = values.compute()
+        return MaskedVolume(self.mask, ascontiguousarray(values))
+
+
+def _sample_priority(t):
+    # splitmix64 hash of a timepoint index: a fixed pseudo-random priority, so that the timepoints kept for percentile
+    # estimation do not depend on how the time series was split into blocks
+    mask = 0xFFFFFFFFFFFFFFFF
+    z = (int(t) + 0x9E3779B97F4A7C15) & mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+    return z ^ (z >> 31)
+
+
+class SummaryAccumulator:
+    def __init__(self, percentiles=(), percentile_samples=100):
+        """
+        Accumulate per-voxel summary statistics (mean, std, min, max and approximate percentiles) over the first axis
+        of a time series, one block of timepoints at a time. Mean and variance use a numerically stable
+        Welford / Chan update, so accumulators built from different parts of the data can be merged exactly.
+        Percentiles are estimated from a uniform random sample of at most ``percentile_samples`` timepoints (bottom-k
+        sampling on a hash of the time index), so the size of the accumulator does not grow with the length of the
+        time series, and merging accumulators gives the same sample as a single pass.
+
+        percentiles : iterable of numbers between 0 and 100.
+
+        percentile_samples : int, maximum number of timepoints kept for percentile estimation.
+        """
+        self.percentiles = tuple(percentiles)
+        self.percentile_samples = percentile_samples
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.samples = {}
+
+    def __repr__(self):
+        return "A summary accumulator over {0} timepoints".format(self.count)
+
+    def update(self, block, t0=0):
+        """
+        Add a block of timepoints to the accumulator.
+
+        block : numpy array with time along the first axis
+
+        t0 : int, the index of the first timepoint of block in the full time series. Used to select the timepoints
+        kept for percentile estimation.
+        """
+        other = SummaryAccumulator(self.percentiles, self.percentile_samples)
+        other.count = block.shape[0]
+        if other.count == 0:
+            return self
+
+        block64 = block.astype("float64")
+        other.mean = block64.mean(0)
+        other.m2 = ((block64 - other.mean) ** 2).sum(0)
+        other.min = block.min(0)
+        other.max = block.max(0)
+
+        if self.percentiles:
+            times = sorted(range(t0, t0 + other.count), key=_sample_priority)[: self.percentile_samples]
+            other.samples = {t: block[t - t0].copy() for t in times}
+
+        return self.merge(other)
+
+    def merge(self, other):
+        """
+        Merge another accumulator into this one, in place, and return self.
+        """
+        from numpy import minimum, maximum
+
+        if other.count == 0:
+            return self
+
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.min = other.min.copy()
+            self.max = other.max.copy()
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * (other.count / count)
+            self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+            self.min = minimum(self.min, other.min)
+            self.max = maximum(self.max, other.max)
+            self.count = count
+
+        if other.samples:
+            self.samples.update(other.samples)
+            for t in sorted(self.samples, key=_sample_priority)[self.percentile_samples :]:
+                del self.samples[t]
+        return self
+
+    def result(self, ddof=0):
+        """
+        Return a dict of summary images: 'mean', 'std', 'min', 'max', and 'p<percentile>' for each percentile.
+        Mean and std are float32.
+        """
+        from numpy import percentile, array, sqrt
+
+        result = dict(
+            mean=self.mean.astype("float32"),
+            std=sqrt(self.m2 / max(self.count - ddof, 1)).astype("float32"),
+            min=self.min,
+            max=self.max,
+        )
+
+        if self.percentiles:
+            samples = array([self.samples[t] for t in sorted(self.samples)])
+            percs = percentile(samples, self.percentiles, axis=0).astype("float32")
+            for p, im in zip(self.percentiles, percs):
+                result["p{0}".format(p)] = im
+
+        return result
+
+    def save(self, path, **metadata):
+        """
+        Save the state of the accumulator to a .npz file, e.g. to checkpoint a long computation. Extra keyword
+        arguments are stored alongside, e.g. to identify the data the accumulator was computed from; they are
+        ignored by SummaryAccumulator.load.
+        """
+        from numpy import savez, array
+
+        times = sorted(self.samples)
+        state = dict(
+            count=self.count,
+            percentiles=array(self.percentiles),
+            percentile_samples=self.percentile_samples,
+            sample_times=array(times, dtype="int"),
+        )
+        if self.count > 0:
+            state.update(mean=self.mean, m2=self.m2, min=self.min, max=self.max)
+        if times:
+            state["samples"] = array([self.samples[t] for t in times])
+        savez(path, **metadata, **state)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Restore an accumulator saved with SummaryAccumulator.save
+        """
+        from numpy import load
+
+        with load(path) as f:
+            result = cls(tuple(f["percentiles"]), int(f["percentile_samples"]))
+            result.count = int(f["count"])
+            if result.count > 0:
+                result.mean = f["mean"]
+                result.m2 = f["m2"]
+                result.min = f["min"]
+                result.max = f["max"]
+            if f["sample_times"].size > 0:
+                result.samples = dict(zip(f["sample_times"].tolist(), f["samples"]))
+        return result
+
+
+def _tree_reduce(partials, combine, split_every=8):
+    """
+    Reduce a list of delayed objects to one with combine(*group), merging at most split_every objects per task, so
+    that the partial results in memory at any time stay bounded regardless of the number of inputs.
+    """
+    from dask import delayed
+
+    combine = delayed(combine)
+    while len(partials) > 1:
+        partials = [combine(*partials[ind : ind + split_every]) for ind in range(0, len(partials), split_every)]
+    return partials[0]
+
+
+def summary_images(
+    data, percentiles=(), percentile_samples=100, checkpoint=None, checkpoint_every=64, split_every=8
+):
+    """
+    Compute mean, std, min, max and approximate percentile images over the first axis of data in a single pass.
+    Returns a dict of images; see SummaryAccumulator.result.
+
+    data : numpy array, dask array, or ZDS with time along the first axis. Dask arrays are processed one time
+    chunk per task, and the partial accumulators are merged in a tree.
+
+    percentiles : iterable of numbers between 0 and 100.
+
+    percentile_samples : int, maximum number of timepoints used for percentile estimation.
+
+    checkpoint : str or None, path to a .npz file. If supplied, the accumulator is saved after every
+    checkpoint_every time chunks and a computation restarted with the same checkpoint resumes after the last
+    saved timepoint, whatever the chunking of data. The checkpoint records the shape and dtype of data and the
+    percentile parameters, and a ValueError is raised if they do not match.
+
+    checkpoint_every : int, number of time chunks processed between checkpoints.
+
+    split_every : int, number of partial accumulators merged per task.
+
+    """
+    from os.path import exists
+    from numpy import cumsum, load
+    from dask import delayed, compute
+    from dask.array.core import Array as DaskArray
+    from .zds import ZDS
+
+    if isinstance(data, ZDS):
+        data = data.data
+
+    if not isinstance(data, DaskArray):
+        return SummaryAccumulator(percentiles, percentile_samples).update(data).result()
+
+    identity = dict(
+        data_shape=tuple(data.shape),
+        data_dtype=data.dtype.str,
+        percentiles=tuple(float(p) for p in percentiles),
+        percentile_samples=percentile_samples,
+    )
+
+    if checkpoint is not None and exists(checkpoint):
+        acc = SummaryAccumulator.load(checkpoint)
+        with load(checkpoint) as f:
+            saved = dict(
+                data_shape=tuple(f["data_shape"].tolist()) if "data_shape" in f else None,
+                data_dtype=str(f["data_dtype"]) if "data_dtype" in f else None,
+                percentiles=tuple(float(p) for p in acc.percentiles),
+                percentile_samples=acc.percentile_samples,
+            )
+        if saved != identity:
+            raise ValueError(
+                "Checkpoint {0} was computed with {1}, which does not match {2}".format(checkpoint, saved, identity)
+            )
+    else:
+        acc = SummaryAccumulator(percentiles, percentile_samples)
+
+    def accumulate(block, t0):
+        return SummaryAccumulator(percentiles, percentile_samples).update(block, t0)
+
+    def merge(*accs):
+        result = accs[0]
+        for a in accs[1:]:
+            result.merge(a)
+        return result
+
+    # resume after the last timepoint in the checkpoint, which need not fall on a chunk boundary of data
+    remaining = data[acc.count :].rechunk({ax: -1 for ax in range(1, data.ndim)})
+    blocks = []
+    if remaining.shape[0] > 0:
+        starts = [acc.count + t0 for t0 in [0, *cumsum(remaining.chunks[0])[:-1]]]
+        blocks = list(zip(remaining.to_delayed().ravel(), starts))
+
+    step = len(blocks) if checkpoint is None else checkpoint_every
+    for ind in range(0, len(blocks), step):
+        partials = [delayed(accumulate)(b, t0) for b, t0 in blocks[ind : ind + step]]
+        acc.merge(compute(_tree_reduce(partials, merge, split_every))[0])
+        if checkpoint is not None:
+            acc.save(checkpoint, data_shape=identity["data_shape"], data_dtype=identity["data_dtype"])
+
+    return acc.result()
+
+
+def randomized_svd(
+    data, k, n_oversamples=10, n_power_iter=2, center=False, block_voxels=2 ** 20, seed=None
+):
+    """
+    Estimate a truncated singular value decomposition (or PCA, if center is True) of a time series of volumes
+    without loading the (T, voxels) matrix into memory. The data are flattened with redim and processed in spatial
+    blocks of at most block_voxels voxels, so memory per task is bounded by the size of one block of the data times
+    the sketch size k + n_oversamples. Each product with the data is computed separately, so the data are read
+    2 + 2 * n_power_iter times, plus once more if center is True, and are never held in memory as a whole.
+
+    Returns the temporal components (T, k), the singular values (k,) and the spatial components, reshaped to
+    (k, *data.shape[1:]).
+
+    data : numpy array, dask array, or ZDS with time along the first axis.
+
+    k : int, number of components to estimate.
+
+    n_oversamples : int, extra dimensions added to the random sketch to improve accuracy.
+
+    n_power_iter : int, number of power iterations. More iterations give more accurate components when the
+    singular values decay slowly, at the cost of two reads of the data per iteration.
+
+    center : bool, if True subtract the temporal mean of each voxel before decomposition, i.e. compute PCA.
+
+    block_voxels : int, maximum number of voxels per spatial block.
+
+    seed : int or None, seed for the random sketch.
+
+    """
+    from numpy import sqrt, ones, float32, asarray
+    from numpy.linalg import qr, eigh
+    from dask import compute
+    from dask.array import from_array
+    from dask.array.random import RandomState
+    from dask.array.core import Array as DaskArray
+    from .zds import ZDS
+
+    if isinstance(data, ZDS):
+        data = data.data
+
+    full_shape = data.shape
+    if not isinstance(data, DaskArray):
+        data = from_array(data, chunks=(max(1, data.shape[0] // 16), *data.shape[1:]))
+
+    flat = redim(data.rechunk({ax: -1 for ax in range(1, data.ndim)}), 2)
+    flat = flat.rechunk((flat.chunks[0], min(block_voxels, flat.shape[1]))).astype(float32)
+    n_time, n_voxels = flat.shape
+    sketch = min(k + n_oversamples, n_time, n_voxels)
+
+    mean = None
+    if center:
+        mean = flat.mean(0).compute()
+
+    def right_multiply(mat):
+        # (T, V) x (V, l), with the mean subtracted from each column if required
+        if mean is None:
+            return (flat @ mat).compute()
+        # one compute, so that the graph of mat is evaluated once for both products
+        result, mean_proj = compute(flat @ mat, mean @ mat)
+        result -= ones((n_time, 1), dtype=float32) @ asarray(mean_proj)[None]
+        return result
+
+    def left_multiply(mat):
+        # (V, T) x (T, l), as a lazy dask array chunked like the voxels of flat
+        result = flat.T @ mat
+        if mean is not None:
+            result = result - mean[:, None] * mat.sum(0)[None]
+        return result
+
+    omega = RandomState(seed).standard_normal(
+        (n_voxels, sketch), chunks=(flat.chunks[1], sketch)
+    ).astype(float32)
+
+    q, _ = qr(right_multiply(omega))
+    for _ in range(n_power_iter):
+        # materialise the (V, l) product, so that the two products read the data one after the other instead of
+        # in one graph that keeps every chunk of the data alive
+        z = left_multiply(q.astype(float32)).compute()
+        q, _ = qr(right_multiply(from_array(z, chunks=(flat.chunks[1], sketch))))
+
+    # b has shape (V, l); it is the size of the output, so keep it in memory
+    b = left_multiply(q.astype(float32)).compute()
+    evals, evecs = eigh(b.T @ b)
+    order = evals.argsort()[::-1][:k]
+    s = sqrt(evals[order].clip(0, None))
+    evecs = evecs[:, order]
+
+    temporal = q @ evecs
+    spatial = (b @ evecs / s.clip(1e-12, None)).T
+
+    return temporal, s, redim(spatial, len(full_shape), shape=(len(s), *full_shape[1:]))
+
+
+def regressor_maps(data, regressors, kind="correlation"):
+    """
+    Compare k regressors (e.g. swim or stimulus traces resampled to volume times) with the time series of every
+    voxel in one pass over the data. Only the sufficient statistics sum(y), sum(y ** 2) and sum(x * y) are
+    accumulated per chunk, so computing many maps costs the same single read as computing one.
+
+    Returns an array of maps with shape (k, *data.shape[1:]) and dtype float32.
+
+    data : numpy array, dask array, or ZDS with time along the first axis.
+
+    regressors : numpy array with shape (T,) or (k, T), where T == data.shape[0].
+
+    kind : string, one of 'correlation' (Pearson correlation of each regressor with each voxel), 'slope' (slope of
+    a separate least-squares fit of each voxel on each regressor), or 'regression' (coefficients of a joint
+    least-squares fit of each voxel on all regressors plus an intercept).
+
+    """
+    from numpy import atleast_2d, asarray, sqrt, errstate, float32, float64
+    from numpy.linalg import pinv
+    from dask import compute
+    from dask.array.core import Array as DaskArray
+    from .zds import ZDS
+
+    if kind not in ("correlation", "slope", "regression"):
+        raise ValueError("kind must be one of 'correlation', 'slope', 'regression'")
+
+    if isinstance(data, ZDS):
+        data = data.data
+
+    x = atleast_2d(asarray(regressors, dtype=float64))
+    if x.shape[1] != data.shape[0]:
+        raise ValueError("Regressors must have the same length as the first axis of data.")
+
+    n = x.shape[1]
+    # centering the regressors makes sum(x * y) the covariance numerator
+    xc = x - x.mean(1, keepdims=True)
+
+    if isinstance(data, DaskArray):
+        data = data.rechunk({ax: -1 for ax in range(1, data.ndim)})
+    flat = redim(data, 2).astype(float64)
+
+    stats = (xc @ flat, flat.sum(0), (flat ** 2).sum(0))
+    if isinstance(flat, DaskArray):
+        stats = compute(*stats)
+    sxy, sy, syy = stats
+
+    with errstate(divide="ignore", invalid="ignore"):
+        if kind == "correlation":
+            ssy = syy - sy ** 2 / n
+            ssx = (xc ** 2).sum(1)
+            maps = sxy / sqrt(ssx[:, None] * ssy[None])
+        elif kind == "slope":
+            maps = sxy / (xc ** 2).sum(1)[:, None]
+        else:
+            maps = pinv(xc @ xc.T) @ sxy
+
+    return redim(maps.astype(float32), data.ndim, shape=(x.shape[0], *data.shape[1:]))
+
+
+def triggered_average(data, events, pre, post, split_every=8):
+    """
+    Estimate the event-triggered mean and variance of a time series of volumes, e.g. swim- or stimulus-triggered
+    averages. Each time chunk of the data is read at most once, and only if it falls within the window of some event:
+    all of the (event, lag) pairs covered by a chunk are accumulated with a single matrix multiplication, and the
+    partial sums of all chunks, each holding only the lags its chunk covers, are then added together in a tree.
+
+    Returns the mean and the variance, each with shape (pre + post, *data.shape[1:]) and dtype float32. Index pre
+    of the first axis corresponds to the timepoint of the event. Events whose window extends past the edges of
+    the data are ignored.
+
+    data : numpy array, dask array, or ZDS with time along the first axis.
+
+    events : 1D array of integers, indices along the first axis of data, e.g. the output of
+    fish.ephys.ephys.match_cam_time.
+
+    pre : int, number of timepoints to include before each event.
+
+    post : int, number of timepoints to include after each event, including the event itself.
+
+    split_every : int, number of partial sums added per task.
+
+    """
+    from numpy import asarray, zeros, add, arange, cumsum, unique, searchsorted, concatenate, float32, float64
+    from dask import delayed, compute
+    from dask.array.core import Array as DaskArray
+    from .zds import ZDS
+
+    if isinstance(data, ZDS):
+        data = data.data
+
+    window = pre + post
+    events = asarray(events, dtype="int")
+    events = events[(events - pre >= 0) & (events + post <= data.shape[0])]
+    if events.size == 0:
+        raise ValueError("No events have a complete window within the data.")
+
+    def accumulate(block, t0):
+        # weights[lag, t] counts the events for which timepoint t0 + t falls at position lag of the window. Only the
+        # lags covered by this block are kept, so a partial result holds at most one row per lag in the block.
+        times = arange(t0, t0 + block.shape[0])
+        lags = times[:, None] - events[None] + pre
+        t_ind, e_ind = (lags >= 0).nonzero()
+        valid = lags[t_ind, e_ind] < window
+        lags, t_ind = lags[t_ind[valid], e_ind[valid]], t_ind[valid]
+        rows = unique(lags)
+        weights = zeros((rows.size, block.shape[0]), dtype=float64)
+        add.at(weights, (searchsorted(rows, lags), t_ind), 1)
+
+        flat = block.reshape(block.shape[0], -1).astype(float64)
+        return rows, weights @ flat, weights @ flat ** 2
+
+    def combine(*partials):
+        rows = unique(concatenate([p[0] for p in partials]))
+        sums = zeros((rows.size, partials[0][1].shape[1]), dtype=float64)
+        sumsq = zeros(sums.shape, dtype=float64)
+        for p_rows, p_sums, p_sumsq in partials:
+            ind = searchsorted(rows, p_rows)
+            sums[ind] += p_sums
+            sumsq[ind] += p_sumsq
+        return rows, sums, sumsq
+
+    if isinstance(data, DaskArray):
+        data = data.rechunk({ax: -1 for ax in range(1, data.ndim)})
+        starts = [0, *cumsum(data.chunks[0])[:-1]]
+        stops = cumsum(data.chunks[0])
+        partials = []
+        for block, t0, t1 in zip(data.to_delayed().ravel(), starts, stops):
+            # skip chunks that no window touches
+            if ((t1 > events - pre) & (t0 < events + post)).any():
+                partials.append(delayed(accumulate)(block, t0))
+        rows, sums, sumsq = compute(_tree_reduce(partials, combine, split_every))[0]
+    else:
+        rows, sums, sumsq = accumulate(asarray(data), 0)
+    mean = sums / events.size
+    var = sumsq / events.size - mean ** 2
+    shape = (window, *data.shape[1:])
+    return mean.reshape(shape).astype(float32), var.clip(0, None).reshape(shape).astype(float32)
+
+
+def downsample(data, factors, func="mean"):
+    """
+    Spatially bin an array by integer factors by reshaping and reducing, e.g. to downsample registered volumes.
+    Trailing elements along an axis that do not fill a complete bin are discarded. Dask arrays are processed
+    blockwise, after rechunking so that chunk boundaries align with the bins.
+
+    'max' and 'min' preserve the dtype of data; 'mean' and 'sum' are accumulated and returned as float32 (or the
+    dtype of data, if that is a wider float).
+
+    data : numpy or dask array.
+
+    factors : iterable of ints with one element per axis of data. Use 1 for axes that should not be binned.
+
+    func : string, one of 'mean', 'max', 'min', 'sum'.
+
+    """
+    from numpy import result_type
+    from dask.array.core import Array as DaskArray
+
+    if func not in ("mean", "max", "min", "sum"):
+        raise ValueError("func must be one of 'mean', 'max', 'min', 'sum'")
+
+    factors = tuple(int(f) for f in factors)
+    if len(factors) != data.ndim:
+        raise ValueError("factors must have one element per axis of data")
+
+    if func in ("mean", "sum"):
+        dtype = result_type(data.dtype, "float32")
+    else:
+        dtype = data.dtype
+
+    # discard trailing elements that do not fill a bin
+    data = data[tuple(slice(0, s - s % f) for s, f in zip(data.shape, factors))]
+
+    def reduce_block(block):
+        binned_shape = []
+        for s, f in zip(block.shape, factors):
+            binned_shape.extend((s // f, f))
+        binned = block.reshape(binned_shape)
+        axes = tuple(range(1, 2 * block.ndim, 2))
+        if func in ("mean", "sum"):
+            return getattr(binned, func)(axis=axes, dtype=dtype)
+        return getattr(binned, func)(axis=axes)
+
+    if isinstance(data, DaskArray):
+        aligned = tuple(
+            max(f, (c[0] // f) * f) if len(c) else f for c, f in zip(data.chunks, factors)
+        )
+        data = data.rechunk(aligned)
+        chunks = tuple(tuple(c // f for c in ch) for ch, f in zip(data.chunks, factors))
+        return data.map_blocks(reduce_block, chunks=chunks, dtype=dtype)
+
+    return reduce_block(data)
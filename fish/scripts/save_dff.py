@@ -11,14 +11,6 @@
 #
 
 
-def get_sc(app_name):
-    from pyspark import SparkConf, SparkContext
-
-    conf = SparkConf().setAppName(app_name)
-    sc = SparkContext(conf=conf)
-    return sc
-
-
 def get_background_offset(raw_path):
     from numpy import median
     from glymur import jp2k
@@ -28,16 +20,6 @@ def get_background_offset(raw_path):
     return median(background_im)
 
 
-def prepare_images(files, context, median_filter_size, background_offset):
-    from thunder import images as tdims
-    from fish.util.fileio import read_image
-
-    images = tdims.fromlist(files, accessor=read_image, engine=context)
-    images = images.map(lambda v: (v - background_offset).clip(1, None))
-    images = images.median_filter(size=median_filter_size)
-    return images
-
-
 def get_params(path):
     import json
 
@@ -46,114 +28,270 @@ def get_params(path):
     return params
 
 
-def motion_correction(images, reg_path, overwrite=False):
-    from scipy.ndimage.interpolation import shift
-    from os.path import exists
-    from os import makedirs
-    from skimage.io import imsave
-    from fish.image.alignment import estimate_translation
-    from numpy import save, array, zeros, vstack, load, arange
-    from scipy.ndimage.filters import median_filter
+def digest(array):
+    """
+    Return a short hash of the contents of an array, used to tie the parameters of a stage to its inputs.
+    """
+    from hashlib import sha1
+    from numpy import ascontiguousarray
 
-    ref_range = arange(-5, 5) + images.shape[0] // 2
-    medfilt_window = 200
+    return sha1(ascontiguousarray(array).tobytes()).hexdigest()[:16]
 
-    if not exists(reg_path):
-        makedirs(reg_path)
-        overwrite = True
 
-    try:
-        affs = load(reg_path + "regparams_affine.npy")
-        print("Registration params found")
-    except FileNotFoundError:
-        print("Registration params not found, performing registration")
-        overwrite = True
+def prepare_images(files, median_filter_size, background_offset):
+    """
+    Load volumes, subtract the background offset and median filter each volume. Returns float32 (T, Z, Y, X).
+    """
+    from numpy import empty
+    from scipy.ndimage import median_filter
+    from fish.util.fileio import read_image
 
-    if overwrite:
-        ref = images[ref_range].mean().toarray().astype("float32")
-        imsave(reg_path + "anat_reference.tif", ref)
-        reg = images.map(lambda v: estimate_translation(ref.max(0), v.max(0))).toarray()
-        affs = array([r.affine for r in reg])
-        save(reg_path + "regparams_affine.npy", affs)
+    images = read_image(list(files)).astype("float32")
+    prepared = empty(images.shape, dtype="float32")
+    for ind, v in enumerate(images):
+        v -= background_offset
+        v.clip(1, None, out=v)
+        median_filter(v, size=median_filter_size, output=prepared[ind])
+    return prepared
 
-    x_trans = median_filter(affs[:, -2, -1], size=medfilt_window)
-    y_trans = median_filter(affs[:, 0, -1], size=medfilt_window)
-    z_trans = zeros(x_trans.shape)
-    trans = vstack([z_trans, y_trans, x_trans])
-    shifter = lambda v: shift(v[1], -trans[:, v[0][0]], cval=0).astype("float32")
-    images_transformed = images.map(shifter, with_keys=True)
 
-    return images_transformed
+def register_chunk(key, files, reference, median_filter_size, background_offset, method, upsample_factor):
+    """
+    Estimate the translation between the max projection of each volume in files[t0:t1] and the reference max
+    projection. Returns affine matrices with the convention of estimate_translation(...).affine.
+    """
+    from numpy import array
+    from fish.image.alignment import estimate_translation, estimate_translation_fft
+
+    t0, t1 = key
+    projections = prepare_images(files[t0:t1], median_filter_size, background_offset).max(1)
+
+    if method == "fft":
+        # one fft thread per worker, the executor provides the parallelism
+        return estimate_translation_fft(reference, projections, upsample_factor=upsample_factor, workers=1)
+    return array([estimate_translation(reference, v).affine for v in projections])
+
+
+def correct_chunk(key, files, translations, median_filter_size, background_offset, factors):
+    """
+    Shift each volume in files[t0:t1] by the negated translations and downsample it. Returns float32 (T, Z, Y, X).
+    """
+    from numpy import empty_like, stack
+    from fish.image.transform import shift_image
+    from fish.image.vol import downsample
+
+    t0, t1 = key
+    images = prepare_images(files[t0:t1], median_filter_size, background_offset)
+    result = []
+    for ind, v in enumerate(images):
+        shifted = shift_image(v, -translations[t0 + ind], kernel="linear", out=empty_like(v), cval=0)
+        result.append(downsample(shifted, factors, func="mean"))
+    return stack(result)
+
+
+def dff_chunk(z, corrected, time_keys, window, percentile, baseline_offset, baseline_downsampling):
+    """
+    Estimate dff along time for one plane of the corrected data. Returns float32 (T, Y, X).
+    """
+    from numpy import concatenate
+    from fish.image.vol import dff
+
+    plane = concatenate([corrected.load(k)[:, z] for k in time_keys])
+    return dff(
+        plane,
+        window=window,
+        percentile=percentile,
+        baseline_offset=baseline_offset,
+        downsample=baseline_downsampling,
+        axis=0,
+    ).astype("float32")
 
 
-def apply_dff(images, dff_fun, out_dtype):
+def bounds_chunk(z, dff_store):
     from numpy import array
+
+    v = dff_store.load(z)
+    return array([v.min(), v.max()])
+
+
+def load_dff(dff_store, n_planes, t0, t1):
+    from numpy import stack
+
+    return stack([dff_store.load(z)[t0:t1] for z in range(n_planes)], axis=1)
+
+
+def rescale_images(images, dff_lim, out_dtype):
     from skimage.exposure import rescale_intensity as rescale
 
-    images_dff = images.map_as_series(
-        dff_fun, value_size=images.shape[0], dtype=images.dtype
-    )
+    return rescale(images, in_range=tuple(dff_lim), out_range=out_dtype).astype(out_dtype)
+
+
+def write_chunk(key, dff_store, n_planes, dff_lim, out_dtype, path):
+    from skimage.io import imsave
+
+    t0, t1 = key
+    images = rescale_images(load_dff(dff_store, n_planes, t0, t1), dff_lim, out_dtype)
+    for ind, v in enumerate(images):
+        imsave(path + "t_{:06d}.tif".format(t0 + ind), v, imagej=True)
+
 
-    bounds = images_dff.map(lambda v: array([v.min(), v.max()])).toarray()
-    mn, mx = bounds.min(), bounds.max()
-    images_rescaled = images_dff.map(
-        lambda v: rescale(v, in_range=(mn, mx), out_range=out_dtype).astype(out_dtype)
+def registration_metadata(files, prepare_params, method, upsample_factor):
+    """
+    Describe the inputs of a registration, to decide whether saved registration params can be reused.
+    """
+    from numpy import array
+    from os.path import basename
+    import json
+
+    meta = dict(
+        prepare_params,
+        method=method,
+        upsample_factor=upsample_factor,
+        n_files=len(files),
+        files=digest(array([basename(f) for f in files])),
     )
-    dff_lim = (mn, mx)
-    return images_rescaled, dff_lim
+    # normalise through json, so that e.g. tuples compare equal to the lists read back from disk
+    return json.loads(json.dumps(meta))
 
 
-def rdd_to_tif(kv, path):
-    from skimage.io import imsave
+def load_registration(reg_path, meta):
+    """
+    Return saved registration params if they were estimated from the same files, with the same parameters, against
+    the saved reference. Returns None otherwise.
+    """
+    from numpy import load
+    from os.path import exists
+    from skimage.io import imread
+    import json
 
-    key = kv[0][0]
-    val = kv[1]
-    fname = "t_{:06d}.tif".format(key)
-    imsave(path + fname, val, imagej=True)
+    fnames = [reg_path + f for f in ("regparams_affine.npy", "regparams.json", "anat_reference.tif")]
+    if not all(exists(f) for f in fnames):
+        return None
 
+    with open(fnames[1], "r") as f:
+        saved = json.load(f)
+    reference = saved.pop("reference", None)
+    affs = load(fnames[0])
 
-def save_images(images, out_path, multifile, exp_name):
-    # save the images
-    if multifile:
-        from os import makedirs
-        from os.path import exists
+    if saved != meta or affs.shape[0] != meta["n_files"]:
+        return None
+    if reference != digest(imread(fnames[2]).astype("float32").max(0)):
+        return None
+    return affs
 
-        # make a folder for all these images
-        subdir = out_path + "dff/"
 
-        if not exists(subdir):
-            makedirs(subdir)
+def motion_correction(pipe, dset, prepare_params, reg_path, overwrite=False, method="dipy", batch_size=16):
+    """
+    Estimate the translation of every volume relative to a reference, or load translations estimated previously.
+    Saved translations are only reused if they were estimated from the same files with the same parameters.
+    Returns an array (3, T) of median filtered z, y, x translations.
+
+    method : string, 'dipy' for estimate_translation or 'fft' for the faster estimate_translation_fft.
+    """
+    from functools import partial
+    from os.path import exists
+    from os import makedirs, replace
+    from skimage.io import imsave, imread
+    from numpy import save, zeros, vstack, arange, concatenate
+    from scipy.ndimage import median_filter
+    import json
+
+    medfilt_window = 200
+    upsample_factor = 20
+    files = dset.files
+    time_keys = get_time_keys(len(files), batch_size)
+    meta = registration_metadata(files, prepare_params, method, upsample_factor)
+
+    if not exists(reg_path):
+        makedirs(reg_path)
+        overwrite = True
 
-        images.tordd().foreach(lambda v: rdd_to_tif(v, subdir))
+    affs = None if overwrite else load_registration(reg_path, meta)
+    if affs is not None:
+        print("Registration params found")
     else:
-        from skimage.io import imsave
+        print("Valid registration params not found, performing registration")
+        ref_range = arange(-5, 5) + len(files) // 2
+        ref = prepare_images(files[ref_range], **prepare_params).mean(0).astype("float32")
+        imsave(reg_path + "anat_reference.tif", ref)
+        # digest the reference as it is read back from disk, as load_registration does
+        ref_proj = imread(reg_path + "anat_reference.tif").astype("float32").max(0)
+
+        params = dict(prepare_params, method=method, upsample_factor=upsample_factor, reference=digest(ref_proj))
+        reg_fun = partial(register_chunk, files=files, reference=ref_proj, method=method,
+                          upsample_factor=upsample_factor, **prepare_params)
+        store = pipe.run("registration", reg_fun, time_keys, params=params, overwrite=True)
+        affs = concatenate([store.load(k, mmap_mode=None) for k in time_keys])
+        save(reg_path + "regparams_affine.npy", affs)
 
-        imsave(out_path + exp_name + ".tif", images.toarray(), imagej=True)
+        # written last, so that params are only reused once registration has completed
+        with open(reg_path + "regparams.json.tmp", "w") as f:
+            json.dump(dict(meta, reference=params["reference"]), f)
+        replace(reg_path + "regparams.json.tmp", reg_path + "regparams.json")
+
+    x_trans = median_filter(affs[:, -2, -1], size=medfilt_window)
+    y_trans = median_filter(affs[:, 0, -1], size=medfilt_window)
+    z_trans = zeros(x_trans.shape)
+    return vstack([z_trans, y_trans, x_trans])
+
+
+def get_time_keys(n_time, batch_size):
+    return [(t0, min(t0 + batch_size, n_time)) for t0 in range(0, n_time, batch_size)]
 
 
 def parse_args():
     from argparse import ArgumentParser
 
     parser = ArgumentParser(
-        description="Generate a df/f volume from raw light sheet data, and save as .tif files."
+        description="Generate a df/f volume from raw light sheet data, and save as .tif files. Intermediate "
+        "results are checkpointed, so an interrupted run resumes where it stopped."
     )
     parser.add_argument("raw_path", help="A path to a directory of raw files.")
     parser.add_argument(
         "param_path", help="A path to a json file containing dff params."
     )
     parser.add_argument("output_path", help="A path to a directory to contain output.")
+    parser.add_argument(
+        "--executor",
+        default="local-processes",
+        choices=("local-processes", "threads", "dask", "serial"),
+        help="How to run tasks. Default is local-processes.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of workers. Defaults to the number of cores."
+    )
+    parser.add_argument(
+        "--scheduler-address",
+        default=None,
+        help="Address of a running dask scheduler, for --executor dask. If not supplied, a local cluster is used.",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=16, help="Number of timepoints processed per task. Default is 16."
+    )
+    parser.add_argument(
+        "--keep-checkpoints",
+        action="store_true",
+        help="Keep the registered and dff data in output_path/checkpoints/ after a successful run.",
+    )
     args = parser.parse_args()
     return args
 
 
-def generate_dff_images(raw_path, param_path, output_path, sc):
+def generate_dff_images(raw_path, param_path, output_path, executor=None, batch_size=16, keep_checkpoints=False):
+    """
+    Register, downsample and estimate dff of an experiment, and save the result as .tif files.
+
+    executor : object with a map(func, iterable) method, e.g. from fish.util.executor.get_executor. Defaults to
+    running in this process.
+    """
     from fish.image.zds import ZDS
-    from fish.image.vol import dff
-    from skimage.transform import downscale_local_mean
+    from fish.util.pipeline import Pipeline
     from functools import partial
+    from numpy import array, concatenate
     import json
     from os.path import exists
     from os import makedirs
+    from shutil import rmtree
 
     dset = ZDS(raw_path)
     # deal with YuMu's convention of renaming the raw data folder
@@ -165,48 +303,112 @@ def generate_dff_images(raw_path, param_path, output_path, sc):
         makedirs(output_path)
 
     reg_path = output_path + "reg/"
+    checkpoint_path = output_path + "checkpoints/"
+    pipe = Pipeline(checkpoint_path, executor=executor)
 
-    dff_fun = partial(
-        dff,
-        window=params["baseline_window"] * dset.metadata["volume_rate"],
-        percentile=params["baseline_percentile"],
-        baseline_offset=params["baseline_offset"],
-        downsample=params["baseline_downsampling"],
+    prepare_params = dict(
+        median_filter_size=(1, 3, 3), background_offset=float(get_background_offset(raw_path))
     )
+    factors = tuple(params["spatial_downsampling"])
+    time_keys = get_time_keys(len(dset.files), batch_size)
 
-    downsample_fun = partial(
-        downscale_local_mean, factors=tuple(params["spatial_downsampling"])
+    print("Registering images...")
+    trans = motion_correction(
+        pipe,
+        dset,
+        prepare_params,
+        reg_path,
+        overwrite=params["overwrite_registration"],
+        method=params.get("registration_method", "dipy"),
+        batch_size=batch_size,
     )
-    background_offset = get_background_offset(raw_path)
-    median_filter_size = (1, 3, 3)
-
-    print("Preparing images...")
-    ims = prepare_images(dset.files, sc, median_filter_size, background_offset)
 
-    print("Registering images...")
-    ims_registered = motion_correction(
-        ims, reg_path, overwrite=params["overwrite_registration"]
+    print("Applying registration and downsampling...")
+    translations = trans.T
+    correct_params = dict(prepare_params, factors=factors, translations=digest(translations))
+    corrected = pipe.run(
+        "corrected",
+        partial(correct_chunk, files=dset.files, translations=translations, factors=factors, **prepare_params),
+        time_keys,
+        params=correct_params,
+        overwrite=True,
     )
-    ims_ds = ims_registered.map(downsample_fun)
+    n_planes = corrected.load(time_keys[0]).shape[1]
 
     print("Estimating dff...")
-    ims_dff, dff_lim = apply_dff(ims_ds, dff_fun, params["out_dtype"])
+    dff_kwargs = dict(
+        window=int(params["baseline_window"] * dset.metadata["volume_rate"]),
+        percentile=params["baseline_percentile"],
+        baseline_offset=params["baseline_offset"],
+        baseline_downsampling=params["baseline_downsampling"],
+    )
+    dff_params = dict(dff_kwargs, upstream=correct_params)
+    dff_store = pipe.run(
+        "dff",
+        partial(dff_chunk, corrected=corrected, time_keys=time_keys, **dff_kwargs),
+        range(n_planes),
+        params=dff_params,
+        overwrite=True,
+    )
+    bounds_store = pipe.run(
+        "dff_bounds", partial(bounds_chunk, dff_store=dff_store), range(n_planes), params=dff_params, overwrite=True
+    )
+    bounds = array([bounds_store.load(z, mmap_mode=None) for z in range(n_planes)])
+    dff_lim = (float(bounds.min()), float(bounds.max()))
 
     print("Saving images...")
+    out_dtype = params["out_dtype"]
+    if params["save_multifile"]:
+        # make a folder for all these images
+        subdir = output_path + "dff/"
+        if not exists(subdir):
+            makedirs(subdir)
+
+        write_params = dict(dff_lim=dff_lim, out_dtype=out_dtype, upstream=dff_params)
+        pipe.run(
+            "write",
+            partial(write_chunk, dff_store=dff_store, n_planes=n_planes, dff_lim=dff_lim, out_dtype=out_dtype,
+                    path=subdir),
+            time_keys,
+            params=write_params,
+            save=False,
+            overwrite=True,
+        )
+    else:
+        from skimage.io import imsave
+
+        images = concatenate(
+            [rescale_images(load_dff(dff_store, n_planes, t0, t1), dff_lim, out_dtype) for t0, t1 in time_keys]
+        )
+        imsave(output_path + dset.exp_name + ".tif", images, imagej=True)
 
-    save_images(
-        ims_dff, output_path, multifile=params["save_multifile"], exp_name=dset.exp_name
-    )
     metadata = params.copy()
-    metadata["dff_lims"] = [float(dff_lim[0]), float(dff_lim[1])]
+    metadata["dff_lims"] = [dff_lim[0], dff_lim[1]]
     metadata_fname = output_path + "dff_metadata.json"
     with open(metadata_fname, "w") as fp:
         json.dump(metadata, fp)
 
+    if not keep_checkpoints:
+        for name in ("corrected", "dff", "dff_bounds", "write"):
+            rmtree(checkpoint_path + name, ignore_errors=True)
+
     return 1
 
 
 if __name__ == "__main__":
+    from fish.util.executor import get_executor
+
     args = parse_args()
-    sc = get_sc("dff_movie")
-    generate_dff_images(args.raw_path, args.param_path, args.output_path, sc)
+    executor_kwargs = dict()
+    if args.executor == "dask" and args.scheduler_address is not None:
+        executor_kwargs["address"] = args.scheduler_address
+
+    with get_executor(args.executor, n_workers=args.workers, **executor_kwargs) as executor:
+        generate_dff_images(
+            args.raw_path,
+            args.param_path,
+            args.output_path,
+            executor=executor,
+            batch_size=args.batch_size,
+            keep_checkpoints=args.keep_checkpoints,
+        )
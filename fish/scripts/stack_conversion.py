@@ -1,36 +1,71 @@
-from glob import glob
-import os
-import volTools as volt
-import fileTools as ftools
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
-from pyspark import SparkConf, SparkContext
+#
+#  Convert raw light sheet data from one file format to another
+#
+# Davis Bennett
+# davis.v.bennett@gmail.com
+#
+# License: MIT
+#
 
-conf = SparkConf().setAppName("image_conversion")
-sc = SparkContext(conf=conf)
 
-to_convert = [
-    "/nobackup/ahrens/davis/data/raw/20160608/6dpf_cy171xcy221_f1_omr_1_20160608_170933/",
-    "/nobackup/ahrens/davis/data/raw/20160608/6dpf_cy171xcy221_f2_omr_1_20160608_190404/",
-    "/nobackup/ahrens/davis/data/raw/20160608/6dpf_cy171xcy221_f2_omr_1_20160608_190404/",
-    "/nobackup/ahrens/davis/data/raw/20160614/5dpf_cy171xcy221_f1_caudal_omr_1_20160614_183344/",
-    "/nobackup/ahrens/davis/data/raw/20160614/5dpf_cy171xcy221_f1_caudal_omr_2_20160614_185018/",
-]
+def done_marker(fname, dest_format):
+    """
+    Path of the empty file recording that fname was converted to dest_format and the result checked.
+    """
+    from os.path import splitext
+
+    return splitext(fname)[0] + "." + dest_format + ".done"
+
+
+def convert_file(fname, dest_format, wipe):
+    """
+    Convert one file. With wipe=False, the converted copy is checked and then a marker is written, so a partially
+    written copy is never mistaken for a finished one.
+    """
+    from numpy import array_equal
+    from os.path import splitext
+    from fish.util.fileio import image_conversion, read_image, write_image
+
+    if wipe:
+        image_conversion(fname, dest_format, wipe=wipe)
+        return fname
+
+    dest_path = splitext(fname)[0] + "." + dest_format
+    source_image = read_image(fname)
+    write_image(dest_path, source_image)
+    if not array_equal(read_image(dest_path), source_image):
+        raise ValueError("{0} and {1} differ".format(fname, dest_path))
+    open(done_marker(fname, dest_format), "w").close()
+    return fname
 
 
-def image_conversion(raw_dir, source_format="stack", dest_format="klb"):
+def image_conversion(raw_dir, executor, source_format="stack", dest_format="klb", wipe=True):
     """
-    Find all files in a directory with a specified format, parallelize this list over a cluster using spark, and convert each file to a new format.
+    Find all files in a directory with a specified format, distribute this list over an executor, and convert each
+    file to a new format. Files whose conversion already completed are skipped, so an interrupted conversion
+    resumes where it stopped.
 
     raw_dir : string
         Directory containing files to be converted
 
+    executor : object with a map(func, iterable) method, e.g. from fish.util.executor.get_executor
+
     source_format : string, default is 'stack'
         The input format of the files to be converted. Supported formats are 'stack' and 'tif'.
 
     dest_format : string, default is 'klb'
         The output format of the converted files. Supported formats are 'klb' and 'hdf5'
+
+    wipe : bool, default is True
+        If True, delete each source file after checking that its converted copy is identical. If False, keep the
+        source files and record each checked conversion with an empty '.done' file next to the converted copy.
     """
+    from functools import partial
     from glob import glob
+    from os.path import exists
 
     # Data files start with `TM`
     source_glob = "{0}TM*.{1}".format(raw_dir, source_format)
@@ -38,10 +73,7 @@ def image_conversion(raw_dir, source_format="stack", dest_format="klb"):
 
     print("Source directory: {0}".format(raw_dir))
 
-    fnames = glob(source_glob)
-    fname_rdd = sc.parallelize(fnames, numSlices=256)
-
-    old_source = fnames
+    old_source = sorted(glob(source_glob))
     old_dest = glob(dest_glob)
 
     print("pre-conversion: number of {0} files: {1}".format(dest_format, len(old_dest)))
@@ -51,12 +83,15 @@ def image_conversion(raw_dir, source_format="stack", dest_format="klb"):
         )
     )
 
-    convert_fun = lambda f: ftools.image_conversion(f, dest_format, wipe=True)
+    # with wipe=False, converted files remain in the source list. Only a marker, written after the converted copy
+    # was checked, counts as done: a destination file alone may be left over from an interrupted write.
+    todo = [f for f in old_source if wipe or not exists(done_marker(f, dest_format))]
 
     if len(old_source) == 0:
         print("No {0} files found!".format(source_format))
     else:
-        fname_rdd.foreach(convert_fun)
+        for _ in executor.map(partial(convert_file, dest_format=dest_format, wipe=wipe), todo):
+            pass
 
     new_dest = glob(dest_glob)
     new_source = glob(source_glob)
@@ -71,8 +106,53 @@ def image_conversion(raw_dir, source_format="stack", dest_format="klb"):
     )
 
 
-for r in to_convert:
-    try:
-        image_conversion(r)
-    except:
-        print("Something went wrong processing {0}".format(r))
+def parse_args():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Convert the raw image files in one or more directories to a new format.")
+    parser.add_argument("raw_dirs", nargs="+", help="Paths to directories of raw files.")
+    parser.add_argument(
+        "--source-format", default="stack", help="Format of the files to convert. Default is stack."
+    )
+    parser.add_argument("--dest-format", default="klb", help="Format to convert to. Default is klb.")
+    parser.add_argument(
+        "--keep-source", action="store_true", help="Keep the source files instead of deleting them after conversion."
+    )
+    parser.add_argument(
+        "--executor",
+        default="threads",
+        choices=("local-processes", "threads", "dask", "serial"),
+        help="How to run tasks. Default is threads, as conversion is mostly I/O.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of workers. Defaults to the number of cores."
+    )
+    parser.add_argument(
+        "--scheduler-address",
+        default=None,
+        help="Address of a running dask scheduler, for --executor dask. If not supplied, a local cluster is used.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from os.path import join
+    from fish.util.executor import get_executor
+
+    args = parse_args()
+    executor_kwargs = dict()
+    if args.executor == "dask" and args.scheduler_address is not None:
+        executor_kwargs["address"] = args.scheduler_address
+
+    with get_executor(args.executor, n_workers=args.workers, **executor_kwargs) as executor:
+        for r in args.raw_dirs:
+            try:
+                image_conversion(
+                    join(r, ""),
+                    executor,
+                    source_format=args.source_format,
+                    dest_format=args.dest_format,
+                    wipe=not args.keep_source,
+                )
+            except Exception as e:
+                print("Something went wrong processing {0}: {1}".format(r, e))
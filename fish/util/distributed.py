@@ -54,13 +54,18 @@ def get_jobqueue_cluster(
     return cluster
 
 
-def get_drmaa_cluster():
+def get_drmaa_cluster(n_workers=None, **kwargs):
     """
     Instatiate a DRMAACluster for use with the LSF scheduler on the Janelia Research Campus compute cluster. This is a
     wrapper for dask_drmaa.DRMMACluster that uses reasonable default settings for the dask workers. Specifically, this
     ensures that dask workers use the /scratch/$USER directory for temporary files and also that each worker runs on a
     single core. This wrapper also directs the $WORKER.err and $WORKER.log files to /scratch/$USER.
 
+    n_workers : int or None, number of workers to start. If None, no workers are started; use cluster.start_workers
+    or adaptive scaling.
+
+    Extra kwargs are passed to DRMAACluster(), and override the defaults above.
+
     """
     from dask_drmaa import DRMAACluster
     import os
@@ -75,7 +80,7 @@ def get_drmaa_cluster():
     local_directory = "/scratch/" + os.environ["USER"]
     output_path = ":" + local_directory
     error_path = output_path
-    cluster_kwargs_pass = {}
+    cluster_kwargs_pass = dict(kwargs)
     cluster_kwargs_pass.setdefault(
         "template",
         {
@@ -85,13 +90,147 @@ def get_drmaa_cluster():
             "errorPath": error_path,
         },
     )
-    cluster_kwargs_pass["preexec_commands"] = pre_exec
+    cluster_kwargs_pass.setdefault("preexec_commands", pre_exec)
     cluster = DRMAACluster(**cluster_kwargs_pass)
+    if n_workers is not None:
+        cluster.start_workers(n_workers)
+    return cluster
+
+
+# environment variables that limit numerical libraries to one thread per dask worker thread
+single_thread_env = dict(
+    NUM_MKL_THREADS="1",
+    MKL_NUM_THREADS="1",
+    OPENBLAS_NUM_THREADS="1",
+    OPENMP_NUM_THREADS="1",
+    OMP_NUM_THREADS="1",
+)
+
+
+def get_resources():
+    """
+    Detect the resources available to this process. Returns a dict with the number of usable cores and the total
+    memory, in bytes. Core counts respect CPU affinity (e.g. from taskset or a batch scheduler) where supported.
+
+    """
+    import os
+
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count()
+
+    try:
+        from psutil import virtual_memory
+
+        memory = virtual_memory().total
+    except ImportError:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    return dict(cores=cores, memory=memory)
+
+
+def get_local_cluster(
+    workload="compute",
+    n_workers=None,
+    threads_per_worker=None,
+    memory_fraction=0.9,
+    local_directory=None,
+    pin_threads=True,
+    **kwargs
+):
+    """
+    Instantiate a dask.distributed LocalCluster sized from the cores and memory of this machine.
+
+    workload : string, 'compute' or 'io'. Compute-heavy work gets one single-threaded worker process per core,
+               which avoids contention for the GIL. I/O-heavy work gets fewer worker processes with 4 threads each,
+               so that many reads can be in flight per process.
+
+    n_workers, threads_per_worker : integers or None, override the sizes chosen from workload.
+
+    memory_fraction : float, fraction of total memory divided evenly between the workers as their memory limit.
+
+    local_directory : string or None, directory where workers spill data to disk. Defaults to $TMPDIR or the
+                      system temporary directory.
+
+    pin_threads : bool, if True set single_thread_env in the environment of the worker processes, so that numerical
+                  libraries in each worker use one thread per worker thread instead of oversubscribing the cores. The
+                  environment of this process is not changed.
+
+    Extra kwargs are passed to LocalCluster().
+
+    """
+    from distributed import LocalCluster
+    from tempfile import gettempdir
+
+    if workload not in ("compute", "io"):
+        raise ValueError("workload must be 'compute' or 'io'")
+
+    resources = get_resources()
+    cores = resources["cores"]
+
+    if threads_per_worker is None:
+        threads_per_worker = 1 if workload == "compute" else min(4, cores)
+    if n_workers is None:
+        n_workers = max(1, cores // threads_per_worker)
+
+    if local_directory is None:
+        local_directory = gettempdir()
+
+    if pin_threads:
+        # passed to the nanny of each worker, which sets it before starting the worker process
+        kwargs["env"] = dict(single_thread_env, **kwargs.get("env", {}))
+
+    memory_limit = int(resources["memory"] * memory_fraction / n_workers)
+
+    cluster = LocalCluster(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=memory_limit,
+        local_directory=local_directory,
+        **kwargs
+    )
+    return cluster
+
+
+def get_cluster(kind="local", adaptive=None, **kwargs):
+    """
+    Instantiate a dask cluster with a common interface for local machines and the LSF / DRMAA schedulers on the
+    Janelia Research Campus compute cluster.
+
+    kind : string, one of 'local' (get_local_cluster), 'lsf' (get_jobqueue_cluster) or 'drmaa' (get_drmaa_cluster).
+
+    adaptive : dict or None. If supplied, enable adaptive scaling with these arguments, e.g.
+               dict(minimum=1, maximum=100).
+
+    Extra kwargs are passed to the function that creates the cluster.
+
+    """
+    factories = dict(
+        local=get_local_cluster, lsf=get_jobqueue_cluster, drmaa=get_drmaa_cluster
+    )
+    if kind not in factories:
+        raise ValueError(
+            "Cluster kind {0} not supported. Use one of {1}".format(kind, tuple(factories))
+        )
+
+    cluster = factories[kind](**kwargs)
+
+    if adaptive is not None:
+        cluster.adapt(**adaptive)
+
     return cluster
 
 
 def get_downsampled_baseline(
-    data, factor=None, keyframes=None, axis=0, perc=None, window=None, mode="reflect"
+    data,
+    factor=None,
+    keyframes=None,
+    axis=0,
+    perc=None,
+    window=None,
+    mode="reflect",
+    keyframes_per_task=None,
 ):
     """
     Generate a dask array that will take the non-sliding windowed percentile of input data along the first axis.
@@ -101,6 +240,10 @@ def get_downsampled_baseline(
     Returns the keyframes and a stacked dask array where each element is the lazy percentile estimated over the
     0th...len(keyframes)th window. The dtype of this array will be float32.
 
+    Keyframes are processed in groups: each group reads one contiguous, overlapping slice of data along axis and
+    evaluates the percentiles of all of its keyframes in one task per spatial block, so the size of the task graph
+    scales with the number of chunks rather than with the number of keyframes.
+
     keyframes : numpy array, timepoints at which to take the windowed percentile.
 
     data : dask array.
@@ -118,47 +261,71 @@ def get_downsampled_baseline(
 
     mode : string, specifies how values at the boundary should be handled. Only supported mode is 'reflect'
 
+    keyframes_per_task : integer or None, number of consecutive keyframes evaluated by each task. If None, groups
+                         are chosen so that each task reads roughly two windows worth of data.
+
     """
 
-    from numpy import linspace, arange, percentile
-    from dask.array import stack
+    from numpy import linspace, arange, percentile, asarray, where, take, stack, diff, median
+    from dask.array import concatenate
+
+    if mode != "reflect":
+        raise ValueError("Only 'reflect' mode is supported.")
 
     if factor is not None:
         keyframes = linspace(0, data.shape[axis] - 1, factor, dtype="int")
     elif keyframes is None:
         raise ValueError("Either factor or keyframes must be specified.")
+    keyframes = asarray(keyframes)
 
+    length = data.shape[axis]
     window_inds = arange(-(window // 2), 1 + (window // 2))
+    width = window_inds.size
     inds = window_inds + keyframes.reshape(-1, 1)
-
-    def get_perc(v):
-        return percentile(v, perc, axis=axis).astype("float32")
-
-    rechunked = []
-
-    for i in inds:
+    positions = arange(width).reshape(1, -1)
+
+    # lower edge: out-of-range indices are replaced with 0, 1, 2...
+    inds = where(inds < 0, positions, inds)
+    # upper edge: out-of-range indices are replaced with length - 1, length - 2, ...
+    n_upper = (inds >= length).sum(1, keepdims=True)
+    inds = where(inds >= length, (length - 1) - (positions - (width - n_upper)), inds)
+
+    if keyframes_per_task is None:
+        spacing = median(diff(keyframes)) if keyframes.size > 1 else width
+        keyframes_per_task = max(1, int(width // max(spacing, 1)))
+
+    def get_perc(block, rows, offset):
+        return stack(
+            [
+                percentile(take(block, r - offset, axis=axis), perc, axis=axis).astype("float32")
+                for r in rows
+            ]
+        )
+
+    groups = []
+    for start in range(0, len(keyframes), keyframes_per_task):
+        rows = inds[start : start + keyframes_per_task]
+        lo, hi = rows.min(), rows.max() + 1
+
+        slices = [slice(None)] * data.ndim
+        slices[axis] = slice(lo, hi)
         new_chunks = ["auto"] * data.ndim
-        new_chunks[axis] = len(i)
-        new_chunks = tuple(new_chunks)
-        # lower edge
-        if i[0] < 0:
-            if mode == "reflect":
-                invalid = i[i < 0]
-                i[i < 0] = arange(len(invalid))
-
-        # upper edge
-        if i[-1] >= data.shape[axis]:
-            if mode == "reflect":
-                invalid = i[i >= data.shape[axis]]
-                i[i >= data.shape[axis]] = arange(
-                    data.shape[axis] - 1, (data.shape[axis] - 1) - len(invalid), -1
-                )
-
-        res = data[i].rechunk(new_chunks)
-        rechunked.append(res)
-
-    stacked = stack(
-        [r.map_blocks(get_perc, dtype="float32", drop_axis=axis) for r in rechunked]
-    )
+        new_chunks[axis] = -1
+        region = data[tuple(slices)].rechunk(tuple(new_chunks))
+
+        out_chunks = [c for ind, c in enumerate(region.chunks) if ind != axis]
+        groups.append(
+            region.map_blocks(
+                get_perc,
+                rows,
+                lo,
+                dtype="float32",
+                drop_axis=axis,
+                new_axis=0,
+                chunks=((len(rows),), *out_chunks),
+            )
+        )
+
+    stacked = concatenate(groups, axis=0)
 
     return keyframes, stacked
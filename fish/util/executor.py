@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+#  Interchangeable executors for running the same chunked job on a laptop or a cluster
+#
+# Davis Bennett
+# davis.v.bennett@gmail.com
+#
+# License: MIT
+#
+
+import os
+from .distributed import single_thread_env, get_resources, get_cluster
+
+
+def _pin_threads():
+    # run in each worker process before any tasks, so that numerical libraries use one thread per process
+    os.environ.update(single_thread_env)
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+class SerialExecutor(object):
+
+    """
+    Run every task in this process, one after another. Useful for debugging.
+    """
+
+    def map(self, func, iterable):
+        return map(func, iterable)
+
+    def shutdown(self, wait=True):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class DaskExecutor(object):
+
+    """
+    Run tasks on a dask.distributed cluster, with the map interface of concurrent.futures executors. Functions and
+    their arguments must be picklable, and every worker must see the same filesystem as this process.
+    """
+
+    def __init__(self, address=None, client=None, **cluster_kwargs):
+        """
+        address : string or None, address of a running scheduler to connect to, e.g. 'tcp://10.0.0.1:8786'.
+
+        client : dask.distributed.Client or None, an existing client to use.
+
+        If neither is supplied, a cluster is created with fish.util.distributed.get_cluster(**cluster_kwargs) and
+        closed again on shutdown.
+        """
+        from distributed import Client
+
+        self.cluster = None
+        self._owns_client = client is None
+        if client is None:
+            if address is None:
+                self.cluster = get_cluster(**cluster_kwargs)
+                address = self.cluster
+            client = Client(address)
+        self.client = client
+
+    def map(self, func, iterable):
+        futures = self.client.map(func, list(iterable), pure=False)
+        return self.client.gather(futures)
+
+    def shutdown(self, wait=True):
+        if self._owns_client:
+            self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def get_executor(kind="local-processes", n_workers=None, **kwargs):
+    """
+    Return an executor with a map(func, iterable) method, to be used as a context manager. Backends with one
+    worker per core and one numerical thread per worker give comparable per-core throughput on a single machine and
+    on a cluster.
+
+    kind : string, one of
+        'local-processes' : a concurrent.futures process pool with one single-threaded process per core.
+        'threads' : a concurrent.futures thread pool. Best for I/O-bound work, e.g. file conversion.
+        'dask' : a dask.distributed cluster, see DaskExecutor. Extra kwargs (address, client, or arguments of
+                 fish.util.distributed.get_cluster) are passed on.
+        'serial' : run in this process.
+
+    n_workers : int or None, number of workers. Defaults to the number of usable cores.
+
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    kinds = ("local-processes", "threads", "dask", "serial")
+    if kind not in kinds:
+        raise ValueError("Executor kind {0} not supported. Use one of {1}".format(kind, kinds))
+
+    if kind == "serial":
+        return SerialExecutor()
+
+    if kind == "dask":
+        if n_workers is not None:
+            kwargs["n_workers"] = n_workers
+        return DaskExecutor(**kwargs)
+
+    if n_workers is None:
+        n_workers = get_resources()["cores"]
+
+    if kind == "threads":
+        return ThreadPoolExecutor(max_workers=n_workers)
+
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_pin_threads)
+
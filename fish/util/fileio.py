@@ -10,6 +10,8 @@
 # License: MIT
 #
 
+from .instrument import instrumented, result_nbytes, arg_nbytes
+
 
 def _tif_reader(tif_path, roi=None):
     from skimage.io import imread
@@ -115,6 +117,7 @@ writers["h5"] = _h5_writer
 writers["jp2"] = _jp2_writer
 
 
+@instrumented("read", bytes_read=result_nbytes)
 def read_image(fname, roi=None, dset_name='default', parallelism=1):
     """
     Load .stack, .tif, .klb, .h5, or jp2 data and return as a numpy array
@@ -167,6 +170,7 @@ def read_image(fname, roi=None, dset_name='default', parallelism=1):
     return result
 
 
+@instrumented("write", bytes_written=arg_nbytes(1, "data"))
 def write_image(fname, data):
     """
     Write a numpy array as .stack, .tif, .klb, or .h5 file
@@ -233,9 +237,10 @@ def image_conversion(source_path, dest_fmt, wipe=False):
 
     from numpy import array_equal
     from os import remove
+    from os.path import splitext
 
     # the name of the file before format extension
-    source_name = source_path.split(".")[0]
+    source_name = splitext(source_path)[0]
 
     dest_path = source_name + "." + dest_fmt
     source_image = read_image(source_path)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+#  Lightweight instrumentation for finding where time, I/O and memory go in a processing pipeline
+#
+# Davis Bennett
+# davis.v.bennett@gmail.com
+#
+# License: MIT
+#
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import local
+import os
+
+
+class Recorder(object):
+
+    """
+    Accumulate per-stage statistics: number of calls, wall time, wall time of calls not nested inside another
+    stage, bytes read and written, and the largest resident set size (RSS) of the process measured at the end of a
+    call. One Recorder exists per process; see get_stats and collect for aggregating across processes and dask
+    workers.
+    """
+
+    fields = ("calls", "wall_time", "top_level_time", "bytes_read", "bytes_written", "max_call_rss")
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = {}
+
+    def record(self, name, wall_time=0.0, top_level_time=0.0, bytes_read=0, bytes_written=0, rss=0, calls=1):
+        entry = self.stats.setdefault(name, dict.fromkeys(self.fields, 0))
+        entry["calls"] += calls
+        entry["wall_time"] += wall_time
+        entry["top_level_time"] += top_level_time
+        entry["bytes_read"] += int(bytes_read)
+        entry["bytes_written"] += int(bytes_written)
+        entry["max_call_rss"] = max(entry["max_call_rss"], int(rss))
+
+    def merge(self, stats):
+        """
+        Add statistics from another recorder, as returned by Recorder.to_dict
+        """
+        for name, entry in stats.items():
+            self.record(
+                name,
+                wall_time=entry["wall_time"],
+                top_level_time=entry["top_level_time"],
+                bytes_read=entry["bytes_read"],
+                bytes_written=entry["bytes_written"],
+                rss=entry["max_call_rss"],
+                calls=entry["calls"],
+            )
+
+    def to_dict(self):
+        return {name: dict(entry) for name, entry in self.stats.items()}
+
+    def reset(self):
+        self.stats = {}
+
+
+# instrumentation is off unless enabled here or through the environment, e.g. of worker processes
+_recorder = Recorder(enabled=os.environ.get("FISH_INSTRUMENT", "0") == "1")
+
+# depth of nested stages in each thread
+_nesting = local()
+
+
+def enable(propagate=True):
+    """
+    Turn on recording in this process. If propagate is True, also set FISH_INSTRUMENT=1 so that worker processes
+    started afterwards record too.
+    """
+    _recorder.enabled = True
+    if propagate:
+        os.environ["FISH_INSTRUMENT"] = "1"
+
+
+def disable():
+    _recorder.enabled = False
+    os.environ.pop("FISH_INSTRUMENT", None)
+
+
+def reset():
+    _recorder.reset()
+
+
+def get_stats():
+    """
+    Return the statistics recorded in this process as a dict of dicts, keyed by stage name.
+    """
+    return _recorder.to_dict()
+
+
+def get_rss():
+    """
+    Return the current resident set size of this process in bytes, or 0 if it cannot be measured.
+    """
+    try:
+        from psutil import Process
+
+        return Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        # the second field is the resident size, in pages
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class _StageHandle(object):
+    def __init__(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add_bytes(self, read=0, written=0):
+        self.bytes_read += read
+        self.bytes_written += written
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager that records the wall time of a block of code under the stage name. The yielded handle has an
+    add_bytes(read=0, written=0) method for reporting I/O done inside the block.
+
+    with stage('write'):
+        ...
+    """
+    from time import perf_counter
+
+    handle = _StageHandle()
+    if not _recorder.enabled:
+        yield handle
+        return
+
+    depth = getattr(_nesting, "depth", 0)
+    _nesting.depth = depth + 1
+    start = perf_counter()
+    try:
+        yield handle
+    finally:
+        wall_time = perf_counter() - start
+        _nesting.depth = depth
+        _recorder.record(
+            name,
+            wall_time=wall_time,
+            top_level_time=wall_time if depth == 0 else 0.0,
+            bytes_read=handle.bytes_read,
+            bytes_written=handle.bytes_written,
+            rss=get_rss(),
+        )
+
+
+def result_nbytes(args, kwargs, result):
+    """
+    Byte counter for instrumented: the size of the returned array.
+    """
+    return getattr(result, "nbytes", 0)
+
+
+def arg_nbytes(index, keyword=None):
+    """
+    Return a byte counter for instrumented that measures the size of a positional (or keyword) array argument.
+    """
+
+    def counter(args, kwargs, result):
+        if keyword is not None and keyword in kwargs:
+            return getattr(kwargs[keyword], "nbytes", 0)
+        if len(args) > index:
+            return getattr(args[index], "nbytes", 0)
+        return 0
+
+    return counter
+
+
+def instrumented(name, bytes_read=None, bytes_written=None):
+    """
+    Decorator that records every call of a function under the stage name. When recording is disabled the only
+    overhead is one attribute lookup per call.
+
+    name : string, stage name, e.g. 'read', 'register', 'baseline', 'write'
+
+    bytes_read, bytes_written : callables or None. Called as f(args, kwargs, result) to count the bytes read or
+    written by a call, e.g. result_nbytes or arg_nbytes(1). Only count bytes in functions that actually read or
+    write storage: a function processing an array already in memory, nested in another stage, would count the same
+    bytes again and inflate the I/O totals.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _recorder.enabled:
+                return func(*args, **kwargs)
+
+            with stage(name) as handle:
+                result = func(*args, **kwargs)
+                handle.add_bytes(
+                    read=0 if bytes_read is None else bytes_read(args, kwargs, result),
+                    written=0 if bytes_written is None else bytes_written(args, kwargs, result),
+                )
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def collect(client=None, directory=None):
+    """
+    Aggregate statistics from this process and, optionally, from dask workers and process pools.
+
+    client : dask.distributed.Client or None. If supplied, statistics from every worker are merged in.
+
+    directory : string or None. If supplied, statistics saved by other processes with dump() into this
+    directory are merged in.
+
+    Returns a dict of dicts keyed by stage name.
+    """
+    from glob import glob
+    import json
+
+    total = Recorder()
+    total.merge(get_stats())
+
+    if client is not None:
+        for stats in client.run(get_stats).values():
+            total.merge(stats)
+
+    if directory is not None:
+        for fname in glob(os.path.join(directory, "stats_*.json")):
+            # statistics of this process are already included
+            if fname == _dump_name(directory):
+                continue
+            with open(fname, "r") as f:
+                total.merge(json.load(f))
+
+    return total.to_dict()
+
+
+def _dump_name(directory):
+    from socket import gethostname
+
+    return os.path.join(directory, "stats_{0}_{1}.json".format(gethostname(), os.getpid()))
+
+
+def dump(directory):
+    """
+    Save the statistics of this process to a JSON file in directory, named by host and process id, to be merged
+    later with collect(directory=...). Useful at the end of tasks run in a process pool.
+    """
+    import json
+
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    with open(_dump_name(directory), "w") as f:
+        json.dump(get_stats(), f)
+
+
+def report(stats=None, path=None):
+    """
+    Summarise statistics per stage, with throughput and share of total wall time, sorted by wall time. Optionally
+    write the summary to a .json or .html file. The time of a stage includes the time of stages nested inside it,
+    e.g. 'dff' includes 'baseline'. The total is the time of calls not nested in another stage, so nested time is
+    counted once. time_fraction is the share of the total spent in a stage; top_level_fraction is the share spent
+    in its calls that were not nested, and adds up to 1 over all stages.
+
+    stats : dict as returned by get_stats or collect. Defaults to the statistics of this process.
+
+    path : string or None. Output file; the format is chosen from the extension.
+
+    Returns the summary as a list of dicts.
+    """
+    import json
+
+    if stats is None:
+        stats = get_stats()
+
+    total_time = sum(entry["top_level_time"] for entry in stats.values()) or 1.0
+    rows = []
+    for name, entry in sorted(stats.items(), key=lambda kv: -kv[1]["wall_time"]):
+        row = dict(stage=name, **entry)
+        seconds = entry["wall_time"] or float("nan")
+        row["read_MBps"] = entry["bytes_read"] / 1e6 / seconds
+        row["write_MBps"] = entry["bytes_written"] / 1e6 / seconds
+        row["time_fraction"] = entry["wall_time"] / total_time
+        row["top_level_fraction"] = entry["top_level_time"] / total_time
+        rows.append(row)
+
+    if path is not None:
+        if path.endswith(".html"):
+            columns = list(rows[0]) if rows else ["stage"]
+            header = "".join("<th>{0}</th>".format(c) for c in columns)
+            body = "".join(
+                "<tr>{0}</tr>".format(
+                    "".join(
+                        "<td>{0:.3g}</td>".format(r[c]) if isinstance(r[c], float) else "<td>{0}</td>".format(r[c])
+                        for c in columns
+                    )
+                )
+                for r in rows
+            )
+            with open(path, "w") as f:
+                f.write(
+                    "<html><body><table border='1'><tr>{0}</tr>{1}</table></body></html>".format(header, body)
+                )
+        else:
+            with open(path, "w") as f:
+                json.dump(rows, f, indent=2)
+
+    return rows
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+#  A lightweight runner for checkpointed, resumable processing pipelines
+#
+# Davis Bennett
+# davis.v.bennett@gmail.com
+#
+# License: MIT
+#
+
+import os
+
+
+def _chunk_name(key):
+    """
+    Convert a chunk key (an int, a string, or a tuple of these) to a file name.
+    """
+    if isinstance(key, (tuple, list)):
+        return "_".join(str(k) for k in key)
+    return str(key)
+
+
+class ChunkStore(object):
+
+    """
+    A directory of per-chunk results for one stage of a pipeline. Each chunk is saved as a .npy file (which can be
+    memory-mapped when loaded) followed by a completion marker, and both are written atomically, so a chunk is
+    either complete or absent even if the process dies mid-write. The parameters of the stage are stored alongside
+    the chunks; opening a store with different parameters raises an error unless overwrite is True, in which case
+    the stale chunks are removed.
+    """
+
+    def __init__(self, path, params=None, overwrite=False):
+        import json
+
+        self.path = path
+        self.params = {} if params is None else params
+        params_path = os.path.join(path, "params.json")
+
+        if os.path.exists(params_path):
+            with open(params_path, "r") as f:
+                old_params = json.load(f)
+            if old_params != json.loads(json.dumps(self.params)):
+                if not overwrite:
+                    raise ValueError(
+                        "Parameters of {0} differ from the stored parameters {1}. Use overwrite=True to discard "
+                        "the stored results.".format(path, old_params)
+                    )
+                self.clear()
+
+        os.makedirs(path, exist_ok=True)
+        self._write(params_path, lambda f: f.write(json.dumps(self.params).encode()))
+
+    def __repr__(self):
+        return "A chunk store at {0} with {1} completed chunks".format(
+            self.path, len(self.completed())
+        )
+
+    def _write(self, fname, writer):
+        # write to a temporary file, then rename, so readers never see a partial file
+        tmp = "{0}.{1}.tmp".format(fname, os.getpid())
+        with open(tmp, "wb") as f:
+            writer(f)
+        os.replace(tmp, fname)
+
+    def _marker(self, key):
+        return os.path.join(self.path, _chunk_name(key) + ".done")
+
+    def _data(self, key):
+        return os.path.join(self.path, _chunk_name(key) + ".npy")
+
+    def done(self, key):
+        return os.path.exists(self._marker(key))
+
+    def completed(self):
+        """
+        Return the names of all completed chunks.
+        """
+        return sorted(f[: -len(".done")] for f in os.listdir(self.path) if f.endswith(".done"))
+
+    def save(self, key, value=None):
+        """
+        Store the result of a chunk, or only mark it complete if value is None.
+        """
+        from numpy import save, asarray
+
+        if value is not None:
+            self._write(self._data(key), lambda f: save(f, asarray(value)))
+        self._write(self._marker(key), lambda f: None)
+
+    def load(self, key, mmap_mode="r"):
+        from numpy import load
+
+        return load(self._data(key), mmap_mode=mmap_mode)
+
+    def to_dask(self, keys, axis=0):
+        """
+        Concatenate the stored results of keys along axis as a lazy dask array, without reading them into memory.
+        """
+        from dask.array import from_array, concatenate
+
+        arrays = [self.load(k) for k in keys]
+        return concatenate([from_array(a, chunks=a.shape) for a in arrays], axis=axis)
+
+    def clear(self):
+        from shutil import rmtree
+
+        if os.path.exists(self.path):
+            rmtree(self.path)
+
+
+def _run_chunk(store, func, save, key):
+    result = func(key)
+    store.save(key, result if save else None)
+    return key
+
+
+class Pipeline(object):
+
+    """
+    Run the stages of a pipeline chunk by chunk, storing the result of every chunk in a ChunkStore under a common
+    directory. Re-running a stage skips chunks that have already completed, so a restarted job only redoes the
+    work that was in progress when it failed.
+
+    pipe = Pipeline('/path/to/output/checkpoints/')
+    reg = pipe.run('registration', register_chunk, keys=range(n_chunks), params=reg_params)
+    registered = reg.to_dask(range(n_chunks))
+    """
+
+    def __init__(self, path, executor=None):
+        """
+        path : string, directory that holds one subdirectory per stage.
+
+        executor : object with a map(func, iterable) method, e.g. a concurrent.futures executor. Defaults to running
+        chunks serially in this process.
+        """
+        self.path = path
+        self.executor = executor
+
+    def stage(self, name, params=None, overwrite=False):
+        """
+        Return the ChunkStore of a stage.
+        """
+        return ChunkStore(os.path.join(self.path, name), params=params, overwrite=overwrite)
+
+    def run(self, name, func, keys, params=None, save=True, overwrite=False):
+        """
+        Run func(key) for every key whose chunk is not yet complete, and store the results.
+
+        name : string, name of the stage.
+
+        func : function of one chunk key. Must be picklable if the executor uses other processes.
+
+        keys : iterable of chunk keys (ints, strings, or tuples of these).
+
+        params : JSON-serializable dict of the parameters of this stage. Stored results computed with different
+        parameters are never reused.
+
+        save : bool, if False only completion is recorded, e.g. for stages that write their own output files.
+
+        overwrite : bool, discard stored results whose parameters differ from params instead of raising an error.
+
+        Returns the ChunkStore of the stage.
+        """
+        from functools import partial
+
+        store = self.stage(name, params=params, overwrite=overwrite)
+        todo = [k for k in keys if not store.done(k)]
+        task = partial(_run_chunk, store, func, save)
+
+        mapper = map if self.executor is None else self.executor.map
+        for _ in mapper(task, todo):
+            pass
+
+        return store
@@ -29,26 +29,107 @@ class ROI(object):
         self.x = []
         self.y = []
 
+    def get_pixels(self, shape=None):
+        """
+        Return the (row, column) indices of the pixels inside the ROI as a tuple of two arrays. Only pixels within
+        the bounding box of the polygon are tested.
+
+        shape : tuple of 2 ints, the shape of the image. Defaults to the shape of self.image.
+        """
+        from numpy import asarray
+
+        if shape is None:
+            shape = self.image.shape
+
+        return _polygon_pixels(asarray(self.y), asarray(self.x), shape[:2])
+
     def get_mask(self):
-        from matplotlib.path import Path
-        from numpy import meshgrid, zeros, array, where
+        from numpy import zeros
 
         data = self.image
         mask = zeros(data.shape, dtype="uint8")
 
         if (len(self.y) > 2) & (len(self.x) > 2):
-
-            points = list(zip(self.y, self.x))
-
-            grid = meshgrid(range(data.shape[0]), range(data.shape[1]))
-            coords = list(zip(grid[0].ravel(), grid[1].ravel()))
-
-            path = Path(points)
-            in_points = array(coords)[where(path.contains_points(coords))[0]]
-            in_points = [tuple(x) for x in in_points]
-            for t in in_points:
-                mask[t] = 255
+            mask[self.get_pixels(data.shape)] = 255
         else:
             print("Mask requires 3 or more points")
 
         return mask
+
+
+def _polygon_pixels(y, x, shape):
+    """
+    Find the pixels of an image with the given shape that lie inside the polygon with vertices (y, x). Returns a
+    tuple (rows, columns) of index arrays.
+    """
+    from matplotlib.path import Path
+    from numpy import floor, ceil, meshgrid, arange, column_stack
+
+    if (len(y) < 3) or (len(x) < 3):
+        return arange(0), arange(0)
+
+    r0 = max(int(floor(y.min())), 0)
+    r1 = min(int(ceil(y.max())) + 1, shape[0])
+    c0 = max(int(floor(x.min())), 0)
+    c1 = min(int(ceil(x.max())) + 1, shape[1])
+
+    if (r1 <= r0) or (c1 <= c0):
+        return arange(0), arange(0)
+
+    rows, cols = meshgrid(arange(r0, r1), arange(c0, c1), indexing="ij")
+    rows, cols = rows.ravel(), cols.ravel()
+    inside = Path(column_stack([y, x])).contains_points(column_stack([rows, cols]))
+
+    return rows[inside], cols[inside]
+
+
+def rois_to_labels(rois, shape=None, dtype="int32"):
+    """
+    Rasterize many ROIs into one label image, where the pixels of the i-th ROI have the value i + 1 and background
+    pixels are 0. Where ROIs overlap, later ROIs take precedence.
+
+    rois : iterable of ROI objects
+
+    shape : tuple of 2 ints, the shape of the label image. Defaults to the shape of the image of the first ROI.
+
+    dtype : dtype of the label image
+    """
+    from numpy import zeros
+
+    rois = list(rois)
+    if shape is None:
+        shape = rois[0].image.shape
+
+    labels = zeros(shape[:2], dtype=dtype)
+    for ind, roi in enumerate(rois):
+        labels[roi.get_pixels(shape)] = ind + 1
+
+    return labels
+
+
+def rois_to_sparse(rois, shape=None):
+    """
+    Rasterize many ROIs into a sparse boolean matrix with shape (n_rois, n_pixels), where row i is the flattened
+    mask of the i-th ROI. Unlike rois_to_labels, overlapping ROIs are preserved.
+
+    rois : iterable of ROI objects
+
+    shape : tuple of 2 ints, the shape of the image. Defaults to the shape of the image of the first ROI.
+    """
+    from numpy import concatenate, full, ravel_multi_index, ones, arange
+    from scipy.sparse import csr_matrix
+
+    rois = list(rois)
+    if shape is None:
+        shape = rois[0].image.shape
+    shape = tuple(shape[:2])
+
+    pixels = [roi.get_pixels(shape) for roi in rois]
+    cols = [ravel_multi_index(p, shape) for p in pixels]
+    rows = concatenate([arange(0)] + [full(c.size, ind) for ind, c in enumerate(cols)])
+    cols = concatenate([arange(0)] + cols)
+
+    return csr_matrix(
+        (ones(cols.size, dtype="bool"), (rows, cols)),
+        shape=(len(rois), shape[0] * shape[1]),
+    )
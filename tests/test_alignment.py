@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift as nd_shift
+
+from fish.image.alignment import estimate_translation, estimate_translation_fft, register_planes
+
+SHIFTS = [(1, 0), (0, -2), (3, 2), (0.5, 1.5), (2, -1), (-3.3, 2.7), (1.25, -0.45)]
+
+
+def brain_image(seed=0, size=128, smooth=False):
+    """
+    A bright ellipse on a dark background, with fine texture or, if smooth, only slow intensity variations.
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size] / size
+    mask = gaussian_filter((((yy - 0.5) / 0.35) ** 2 + ((xx - 0.45) / 0.25) ** 2 < 1).astype("float64"), 3)
+    image = 10 + 100 * mask
+    if smooth:
+        image += 200 * gaussian_filter(rng.normal(size=(size, size)), 8)
+    else:
+        image += 40 * mask * gaussian_filter(rng.normal(size=(size, size)), 2)
+    return image.astype("float32")
+
+
+def shifted(image, shift):
+    return nd_shift(image, shift, order=3, mode="nearest")
+
+
+@pytest.mark.parametrize("smooth", [False, True])
+def test_fft_recovers_integer_and_subpixel_shifts(smooth):
+    reference = brain_image(smooth=smooth)
+    moving = np.array([shifted(reference, s) for s in SHIFTS])
+
+    affines = estimate_translation_fft(reference, moving)
+
+    assert affines.shape == (len(SHIFTS), 3, 3)
+    np.testing.assert_allclose(affines[:, :-1, -1], SHIFTS, atol=0.05)
+
+
+def test_fft_single_image_and_large_shift():
+    reference = brain_image(seed=1, smooth=True)
+    affine = estimate_translation_fft(reference, shifted(reference, (-12.4, 9.7)))
+
+    assert affine.shape == (3, 3)
+    np.testing.assert_allclose(affine[:-1, -1], (-12.4, 9.7), atol=0.1)
+
+
+def test_fft_is_robust_to_noise():
+    rng = np.random.default_rng(2)
+    reference = brain_image(seed=2)
+    moving = np.array([shifted(reference, s) for s in SHIFTS])
+
+    affines = estimate_translation_fft(
+        reference + rng.normal(0, 2, reference.shape), moving + rng.normal(0, 2, moving.shape)
+    )
+    np.testing.assert_allclose(affines[:, :-1, -1], SHIFTS, atol=0.1)
+
+
+def test_fft_3d():
+    rng = np.random.default_rng(3)
+    reference = (100 + 50 * gaussian_filter(rng.normal(size=(8, 64, 64)), (1, 2, 2))).astype("float32")
+    shift = (0.6, -1.5, 2.25)
+
+    affine = estimate_translation_fft(reference, shifted(reference, shift))
+    np.testing.assert_allclose(affine[:-1, -1], shift, atol=0.1)
+
+
+@pytest.mark.parametrize("smooth", [False, True])
+def test_fft_agrees_with_dipy(smooth):
+    reference = brain_image(seed=4, smooth=smooth)
+    for shift in [(1, 0), (0.5, 1.5), (2, -1)]:
+        moving = shifted(reference, shift)
+        fft = estimate_translation_fft(reference, moving)[:-1, -1]
+        dipy = estimate_translation(reference, moving).affine[:-1, -1]
+        np.testing.assert_allclose(fft, dipy, atol=0.1)
+
+
+def test_register_planes_smooth_and_structured_planes():
+    rng = np.random.default_rng(5)
+    reference = np.array([brain_image(seed=z, smooth=z % 2 == 1) for z in range(4)])
+    # each plane drifts differently
+    shifts = rng.uniform(-3, 3, (6, 4, 2))
+    data = np.array([[shifted(reference[z], shifts[t, z]) for z in range(4)] for t in range(6)])
+
+    result = register_planes(data, reference=reference, medfilt_window=None, batch_size=4, scheduler="threads")
+
+    assert result.shape == (6, 4, 2)
+    np.testing.assert_allclose(result, shifts, atol=0.05)
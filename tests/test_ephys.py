@@ -0,0 +1,25 @@
+import numpy as np
+
+from fish.ephys.ephys import estimate_threshold, sliding_threshold
+
+
+def test_sliding_threshold_empty_signal():
+    for func in (sliding_threshold, estimate_threshold):
+        kwargs = dict(sliding=True) if func is estimate_threshold else {}
+        result = func(np.zeros(0, dtype="float32"), window=100, **kwargs)
+        assert result.shape == (0,)
+
+
+def test_sliding_threshold_matches_centred_windows():
+    rng = np.random.default_rng(0)
+    signal = rng.normal(size=1000) ** 2
+    window = 101
+
+    result = sliding_threshold(signal, window=window, step=1)
+
+    for t in (0, 10, 500, 999):
+        start = min(max(t - window // 2, 0), signal.size - window)
+        block = signal[start : start + window]
+        med = np.median(block)
+        expected = med + 1.6 * (med - np.percentile(block, 0.01))
+        np.testing.assert_allclose(result[t], expected)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, shift as nd_shift
+from skimage.io import imsave
+
+from fish.scripts.save_dff import motion_correction
+from fish.util.pipeline import Pipeline
+
+
+class Dataset(object):
+    def __init__(self, files):
+        self.files = np.array(files)
+
+
+@pytest.mark.parametrize("method", ["dipy", "fft"])
+def test_motion_correction_recovers_shifts(tmp_path, method):
+    rng = np.random.default_rng(0)
+    n_time = 24
+    yy, xx = np.mgrid[:8, :128, :128][1:] / 128
+    mask = gaussian_filter((((yy - 0.5) / 0.35) ** 2 + ((xx - 0.45) / 0.25) ** 2 < 1).astype("float64"), (0, 3, 3))
+    volume = 200 + 1000 * mask + 2000 * gaussian_filter(rng.normal(size=mask.shape), (1, 8, 8))
+
+    # smooth, noisy volumes; the reference is the mean of the middle 10 timepoints, which are not shifted
+    shifts = rng.uniform(-2, 1, (n_time, 2))
+    shifts[n_time // 2 - 5 : n_time // 2 + 5] = 0
+    files = []
+    for t, (dy, dx) in enumerate(shifts):
+        fname = str(tmp_path / "TM{0:05d}.tif".format(t))
+        image = nd_shift(volume, (0, dy, dx), order=3, mode="nearest") + rng.normal(0, 20, volume.shape)
+        imsave(fname, image.astype("uint16"), check_contrast=False)
+        files.append(fname)
+
+    reg_path = str(tmp_path / "reg") + "/"
+    prepare_params = dict(median_filter_size=(1, 3, 3), background_offset=100.0)
+    pipe = Pipeline(str(tmp_path / "checkpoints") + "/")
+    trans = motion_correction(pipe, Dataset(files), prepare_params, reg_path, method=method, batch_size=8)
+
+    affines = np.load(reg_path + "regparams_affine.npy")
+    np.testing.assert_allclose(affines[:, :-1, -1], shifts, atol=0.15)
+    assert trans.shape == (3, n_time)
+    np.testing.assert_array_equal(trans[0], 0)
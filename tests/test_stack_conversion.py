@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+from skimage.io import imsave
+
+from fish.scripts.stack_conversion import image_conversion
+from fish.util.executor import SerialExecutor
+from fish.util.fileio import read_image
+
+
+def test_keep_source_in_relative_dotted_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("raw.v1")
+    images = [np.full((2, 4, 4), t, dtype="uint16") for t in range(3)]
+    for t, im in enumerate(images):
+        imsave("raw.v1/TM{0:05d}.tif".format(t), im, check_contrast=False)
+
+    image_conversion("./raw.v1/", SerialExecutor(), source_format="tif", dest_format="h5", wipe=False)
+
+    for t, im in enumerate(images):
+        np.testing.assert_array_equal(read_image("raw.v1/TM{0:05d}.h5".format(t)), im)
+        assert os.path.exists("raw.v1/TM{0:05d}.h5.done".format(t))
+        assert os.path.exists("raw.v1/TM{0:05d}.tif".format(t))
@@ -0,0 +1,51 @@
+import dask.array as da
+import numpy as np
+import pytest
+
+from fish.image.vol import summary_images
+
+
+def interrupted_after(data, n_chunks):
+    """
+    A dask array that raises when chunks after the first n_chunks along time are computed.
+    """
+
+    def check(block, block_info=None):
+        if block_info[0]["chunk-location"][0] >= n_chunks:
+            raise RuntimeError("interrupted")
+        return block
+
+    return data.map_blocks(check, dtype=data.dtype)
+
+
+def test_summary_images_resumes_with_different_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    raw = rng.normal(size=(60, 4, 5)).astype("float32")
+    checkpoint = str(tmp_path / "summary.npz")
+    kwargs = dict(percentiles=(10, 50), percentile_samples=60, checkpoint=checkpoint, checkpoint_every=2)
+
+    with pytest.raises(RuntimeError):
+        summary_images(interrupted_after(da.from_array(raw, chunks=(7, 4, 5)), 3), **kwargs)
+
+    result = summary_images(da.from_array(raw, chunks=(10, 4, 5)), **kwargs)
+
+    np.testing.assert_allclose(result["mean"], raw.mean(0), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(result["std"], raw.std(0), rtol=1e-5)
+    np.testing.assert_array_equal(result["min"], raw.min(0))
+    np.testing.assert_array_equal(result["max"], raw.max(0))
+    np.testing.assert_allclose(result["p50"], np.percentile(raw, 50, axis=0), rtol=1e-5)
+
+
+def test_summary_images_rejects_mismatched_checkpoint(tmp_path):
+    rng = np.random.default_rng(1)
+    raw = rng.normal(size=(30, 4, 5)).astype("float32")
+    checkpoint = str(tmp_path / "summary.npz")
+    summary_images(da.from_array(raw, chunks=(10, 4, 5)), percentiles=(50,), checkpoint=checkpoint)
+
+    with pytest.raises(ValueError):
+        summary_images(da.from_array(raw[:20], chunks=(10, 4, 5)), percentiles=(50,), checkpoint=checkpoint)
+    with pytest.raises(ValueError):
+        summary_images(da.from_array(raw.astype("float64"), chunks=(10, 4, 5)), percentiles=(50,),
+                       checkpoint=checkpoint)
+    with pytest.raises(ValueError):
+        summary_images(da.from_array(raw, chunks=(10, 4, 5)), percentiles=(90,), checkpoint=checkpoint)